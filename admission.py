@@ -0,0 +1,131 @@
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+import contextlib
+from rate_limiter import TokenBucket
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+REJECTED = registry.counter("unity_admission_rejected_total", "Chat messages turned away before any AI request, by reason", ["reason"])
+PENDING = registry.gauge("unity_admission_pending", "Admitted chat messages queued or being answered")
+SLOT_WAIT = registry.histogram("unity_admission_wait_seconds", "Time admitted chat messages waited for a fair-share request slot")
+
+REJECTION_MESSAGES = {
+    "user": "You're sending messages too quickly - please wait a moment before trying again.",
+    "guild": "This server is sending a lot of messages right now - please try again shortly.",
+    "busy": "I'm busy right now - please try again in a moment.",
+}
+
+# Sits in front of MessageHandler. admit() applies per-user and per-guild token buckets and sheds load once
+# too many admitted messages are outstanding, so nothing is queued that would only time out upstream.
+# slot() hands out the request slots in start-time fair queuing order across guilds, so a busy guild
+# cannot starve quiet ones; GUILD_WEIGHTS gives some guilds a larger share.
+class AdmissionController:
+    def __init__(self, config):
+        self.user_rate = config.admission_user_rate
+        self.user_burst = config.admission_user_burst
+        self.guild_rate = config.admission_guild_rate
+        self.guild_burst = config.admission_guild_burst
+        self.max_pending = config.admission_max_pending
+        self.capacity = max(config.max_concurrent_requests, 1)
+        self.weights = config.guild_weights
+        self.notice_interval = 30
+        self.user_buckets = {}
+        self.guild_buckets = {}
+        self.last_notice = {}
+        self.pending = 0
+        self.active = 0
+        self.waiting = []
+        self.finish_tags = {}
+        self.virtual_time = 0.0
+        self._order = itertools.count()
+        self.stats = {"admitted": 0, "rejected": 0, "rejected_user": 0, "rejected_guild": 0, "rejected_busy": 0, "queued": 0}
+        PENDING.set_function(lambda: self.pending)
+
+    @staticmethod
+    def guild_key(guild_id, user_id):
+        # Each DM conversation counts as its own "guild"
+        return f"DM:{user_id}" if guild_id == "DM" else guild_id
+
+    def _take(self, buckets, key, rate, burst, now):
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= 10000:
+                # Full buckets behave exactly like new ones
+                for stale in [k for k, b in buckets.items() if b.full(now)]:
+                    del buckets[stale]
+            bucket = buckets[key] = TokenBucket(rate, burst)
+        return bucket.try_acquire(now)
+
+    def admit(self, guild_id, user_id):
+        now = time.monotonic()
+        reason = None
+        if self.max_pending > 0 and self.pending >= self.max_pending:
+            reason = "busy"
+        elif self.user_rate > 0 and not self._take(self.user_buckets, (guild_id, user_id), self.user_rate, self.user_burst, now):
+            reason = "user"
+        elif self.guild_rate > 0 and not self._take(self.guild_buckets, self.guild_key(guild_id, user_id), self.guild_rate, self.guild_burst, now):
+            reason = "guild"
+        if reason is not None:
+            self.stats["rejected"] += 1
+            self.stats[f"rejected_{reason}"] += 1
+            REJECTED.inc(reason=reason)
+            return reason
+        self.pending += 1
+        self.stats["admitted"] += 1
+        return None
+
+    def release(self, count=1):
+        self.pending -= count
+
+    # Answer a rejected user at most once per notice interval so spam doesn't turn into reply spam
+    def should_notify(self, user_id):
+        now = time.monotonic()
+        if now - self.last_notice.get(user_id, float("-inf")) < self.notice_interval:
+            return False
+        if len(self.last_notice) >= 10000:
+            self.last_notice = {k: t for k, t in self.last_notice.items() if now - t < self.notice_interval}
+        self.last_notice[user_id] = now
+        return True
+
+    @contextlib.asynccontextmanager
+    async def slot(self, guild_key):
+        start = max(self.virtual_time, self.finish_tags.get(guild_key, 0.0))
+        self.finish_tags[guild_key] = start + 1 / self.weights.get(guild_key, 1.0)
+        if self.active < self.capacity and not self.waiting:
+            self.active += 1
+            self.virtual_time = start
+        else:
+            self.stats["queued"] += 1
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self.waiting, (start, next(self._order), future))
+            waited = time.perf_counter()
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # The slot was handed over just as we were cancelled; pass it on
+                    self._release_slot()
+                raise
+            SLOT_WAIT.observe(time.perf_counter() - waited)
+        try:
+            yield
+        finally:
+            self._release_slot()
+
+    def _release_slot(self):
+        while self.waiting:
+            start, _, future = heapq.heappop(self.waiting)
+            if not future.done():
+                self.virtual_time = start
+                future.set_result(None)
+                return
+        self.active -= 1
+        if not self.active and len(self.finish_tags) >= 10000:
+            self.finish_tags = {k: tag for k, tag in self.finish_tags.items() if tag > self.virtual_time}
+
+    def snapshot(self):
+        return {"pending": self.pending, "active": self.active, "waiting": len(self.waiting), **self.stats}
@@ -1,17 +1,52 @@
 import aiohttp
+import json
+import time
 import random
 import asyncio
+import contextlib
 import logging
-from typing import List, Dict, Any
+from typing import List, Dict, Any, AsyncIterator
+from response_cache import ResponseCache
+from rate_limiter import AdaptiveRateLimiter, CircuitBreaker, parse_retry_after
+from router import EndpointRouter
+from metrics import registry
 
 logger = logging.getLogger(__name__)
 
+REQUEST_SECONDS = registry.histogram("unity_api_request_seconds", "Pollinations HTTP request latency", ["method", "status"])
+RETRIES = registry.counter("unity_api_retries_total", "Pollinations requests retried, by reason", ["reason"])
+
+# Prefix of the reply given while an endpoint's circuit breaker is open
+UNAVAILABLE = "Error: The AI service is temporarily unavailable"
+
 class APIClient:
     def __init__(self, config):
         self.config = config
         self.session: aiohttp.ClientSession | None = None
         self.retry_attempts = 6
         self.retry_delay = 2
+        self.max_retry_delay = 30
+        self.rate_limiter = AdaptiveRateLimiter(config.api_rate_limit, config.api_rate_burst)
+        # One breaker per endpoint, so a dead fallback cannot block a healthy primary; background requests
+        # (summaries) get their own, so their failures never turn replies away
+        self.breakers = {}
+        self.background_breakers = {}
+        self.router = EndpointRouter(config.api_urls, config.model_fallbacks, config.hedge_delay)
+        self.max_concurrent_requests = config.max_concurrent_requests
+        self.in_flight = 0
+        self._slots: asyncio.Semaphore | None = None
+        self.response_cache = ResponseCache(config.cache_max_entries, config.cache_ttl)
+
+    @contextlib.asynccontextmanager
+    async def _request_slot(self):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrent_requests)
+        async with self._slots:
+            self.in_flight += 1
+            try:
+                yield
+            finally:
+                self.in_flight -= 1
 
     async def initialize(self) -> None:
         if self.session is None or self.session.closed:
@@ -22,30 +57,91 @@ class APIClient:
             await self.session.close()
             self.session = None
 
-    async def _request_json(self, method: str, url: str, **kwargs) -> Dict[str, Any] | str:
+    def breaker_for(self, url: str, background: bool = False) -> CircuitBreaker:
+        breakers = self.background_breakers if background else self.breakers
+        breaker = breakers.get(url)
+        if breaker is None:
+            name = url.split("?")[0] + (" (background)" if background else "")
+            breaker = breakers[url] = CircuitBreaker(self.config.breaker_failure_threshold, self.config.breaker_cooldown, name=name)
+        return breaker
+
+    def breaker_snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {breaker.name: breaker.snapshot() for breaker in [*self.breakers.values(), *self.background_breakers.values()]}
+
+    def _unavailable_message(self, breaker: CircuitBreaker) -> str:
+        return f"{UNAVAILABLE} - please try again in {max(breaker.retry_in(), 1):.0f} seconds."
+
+    def _backoff(self, attempt: int) -> float:
+        return min(self.retry_delay * (2 ** attempt), self.max_retry_delay) + random.uniform(0, 0.1)
+
+    # No wait after the last try: a route with one attempt hands over to the next endpoint straight away
+    async def _retry_wait(self, attempt: int, retry_attempts: int, reason: str) -> None:
+        if attempt + 1 >= retry_attempts:
+            return
+        delay = self._backoff(attempt)
+        logger.warning(f"Retry {attempt + 1}/{retry_attempts} {reason} wait {delay:.2f}s")
+        await asyncio.sleep(delay)
+
+    async def _request_json(self, method: str, url: str, retry_attempts: int | None = None, rate_limiter: AdaptiveRateLimiter | None = None,
+                            breaker: CircuitBreaker | None = None, **kwargs) -> Dict[str, Any] | str:
         if self.session is None or self.session.closed:
             await self.initialize()
-        for attempt in range(self.retry_attempts):
+        retry_attempts = retry_attempts or self.retry_attempts
+        rate_limiter = rate_limiter or self.rate_limiter
+        breaker = breaker or self.breaker_for(url)
+        for attempt in range(retry_attempts):
+            if not breaker.ready():
+                logger.warning(f"Circuit breaker {breaker.state}; rejecting request to {breaker.name}")
+                return self._unavailable_message(breaker)
+            await rate_limiter.acquire()
+            # Take the half-open probe only once the request is about to go out
+            if not breaker.allow():
+                logger.warning(f"Circuit breaker {breaker.state}; rejecting request to {breaker.name}")
+                return self._unavailable_message(breaker)
+            probe = breaker.probing
+            started = time.perf_counter()
             try:
                 async with self.session.request(method, url, **kwargs) as resp:
+                    REQUEST_SECONDS.observe(time.perf_counter() - started, method=method, status=resp.status)
                     if resp.status == 200:
+                        breaker.record_success()
+                        rate_limiter.on_success()
                         return await resp.json()
-                    if resp.status in {429, 500, 502, 503, 504}:
-                        delay = self.retry_delay * (2 ** attempt) + random.uniform(0, 0.1)
-                        logger.warning(f"Retry {attempt + 1}/{self.retry_attempts} status {resp.status} wait {delay:.2f}s")
-                        await asyncio.sleep(delay)
+                    if resp.status == 429:
+                        breaker.record_success()
+                        retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+                        rate_limiter.on_throttled(retry_after)
+                        RETRIES.inc(reason="429")
+                        if retry_after is None:
+                            await self._retry_wait(attempt, retry_attempts, "status 429")
+                        else:
+                            logger.warning(f"Retry {attempt + 1}/{retry_attempts} status 429 Retry-After {retry_after:.2f}s")
                         continue
+                    if resp.status in {500, 502, 503, 504}:
+                        breaker.record_failure()
+                        RETRIES.inc(reason=resp.status)
+                        await self._retry_wait(attempt, retry_attempts, f"status {resp.status}")
+                        continue
+                    breaker.record_success()
                     try:
                         error_text = await resp.text()
                     except Exception:
                         error_text = ""
                     return f"Error: API returned status {resp.status} {error_text}"
+            except asyncio.CancelledError:
+                if probe:
+                    breaker.abandon_probe()
+                raise
             except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
-                delay = self.retry_delay * (2 ** attempt) + random.uniform(0, 0.1)
-                logger.warning(f"Retry {attempt + 1}/{self.retry_attempts} due to {e} wait {delay:.2f}s")
-                await asyncio.sleep(delay)
+                status = "timeout" if isinstance(e, asyncio.TimeoutError) else "connection_error"
+                REQUEST_SECONDS.observe(time.perf_counter() - started, method=method, status=status)
+                RETRIES.inc(reason=status)
+                breaker.record_failure()
+                await self._retry_wait(attempt, retry_attempts, f"due to {e}")
                 continue
             except Exception as e:
+                REQUEST_SECONDS.observe(time.perf_counter() - started, method=method, status="error")
+                breaker.record_failure()
                 logger.error(f"Unexpected exception {e}")
                 return f"Error: Unexpected exception {e}"
         logger.error("API unreachable after retries")
@@ -58,7 +154,8 @@ class APIClient:
                 return [{"name": m.strip()} for m in result]
             if all(isinstance(m, dict) and "name" in m for m in result):
                 return [{"name": m["name"].strip(), "description": m.get("description", "")} for m in result]
-        return [{"name": "unity", "description": "Default unity model"}]
+        # Empty means "unknown"; ModelCatalog keeps its cached list rather than replacing it with a default
+        return []
 
     async def send_message(self, messages: list, model: str | None):
         if self.session is None or self.session.closed:
@@ -73,13 +170,155 @@ class APIClient:
             "max_tokens": 1024,
             "stream": False
         }
+        key = ResponseCache.make_key(model, messages, payload["temperature"], payload["max_tokens"])
+        cacheable = model.lower() in self.config.cache_models
+        return await self.response_cache.run(key, lambda: self._complete(payload), cacheable)
+
+    # For work nobody is waiting on (summaries): paced by the caller's limiter rather than the reply one,
+    # outside the reply slots and cache, with its own breaker, and without touching endpoint health
+    async def send_background(self, messages: list, model: str, rate_limiter: AdaptiveRateLimiter) -> str:
+        url, model = self.router.routes(model)[0]
+        payload = {"messages": messages, "model": model, "temperature": 0.7, "max_tokens": 1024, "stream": False}
+        result = await self._request_json(
+            "POST", url, json=payload, timeout=aiohttp.ClientTimeout(total=60), retry_attempts=2,
+            rate_limiter=rate_limiter, breaker=self.breaker_for(url, background=True),
+        )
+        if isinstance(result, str):
+            return result
         try:
-            result = await self._request_json("POST", self.config.api_url, json=payload, timeout=aiohttp.ClientTimeout(total=30))
+            return result["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, TypeError) as e:
+            return f"Error: Invalid response format {e}"
+
+    async def _complete(self, payload: Dict[str, Any]) -> str:
+        routes = self.router.routes(payload["model"])
+        loop = asyncio.get_running_loop()
+        attempts = {}
+        pending = set()
+        result = "Error: Upstream API unreachable after retries"
+        hedged = False
+
+        def launch(index):
+            url, model = routes[index]
+            task = loop.create_task(self._attempt(url, model, payload, last=index == len(routes) - 1))
+            attempts[task] = index
+            pending.add(task)
+
+        launch(0)
+        next_index = 1
+        try:
+            while pending:
+                timeout = None
+                if self.config.hedge_requests and not hedged and next_index < len(routes):
+                    timeout = self.router.hedge_delay(*routes[0])
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    self.router.stats["hedged"] += 1
+                    logger.info(f"Hedging request to {routes[next_index][1]} after {timeout:.2f}s")
+                    launch(next_index)
+                    next_index += 1
+                    continue
+                for task in done:
+                    result = task.result()
+                    if not result.startswith("Error:"):
+                        if attempts[task] > 0 and hedged:
+                            self.router.stats["hedge_wins"] += 1
+                        return result
+                if not pending and next_index < len(routes):
+                    self.router.stats["failovers"] += 1
+                    logger.warning(f"Failing over to {routes[next_index][1]} after: {result}")
+                    launch(next_index)
+                    next_index += 1
+            return result
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _attempt(self, url: str, model: str, payload: Dict[str, Any], last: bool = True) -> str:
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        try:
+            async with self._request_slot():
+                result = await self._request_json(
+                    "POST", url, json={**payload, "model": model}, timeout=aiohttp.ClientTimeout(total=30),
+                    retry_attempts=None if last else 1,
+                )
         except asyncio.TimeoutError:
+            self.router.record_failure(url, model)
             return "Error: Request timed out"
         if isinstance(result, str):
+            # A breaker-open reply says nothing new about this endpoint's health
+            if not result.startswith(UNAVAILABLE):
+                self.router.record_failure(url, model)
             return result
         try:
-            return result["choices"][0]["message"]["content"]
+            content = result["choices"][0]["message"]["content"]
         except (KeyError, IndexError, TypeError) as e:
+            self.router.record_failure(url, model)
             return f"Error: Invalid response format {e}"
+        self.router.record_success(url, model, loop.time() - started)
+        return content
+
+    async def stream_message(self, messages: list, model: str | None) -> AsyncIterator[str]:
+        if self.session is None or self.session.closed:
+            await self.initialize()
+        if not model or not isinstance(model, str) or model.strip() == "":
+            model = self.config.default_model
+        logger.info(f"Streaming with model: {model}")
+        payload = {
+            "messages": messages,
+            "model": model,
+            "temperature": 0.7,
+            "max_tokens": 1024,
+            "stream": True
+        }
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=30)
+        url, model = self.router.routes(model)[0]
+        payload["model"] = model
+        breaker = self.breaker_for(url)
+        if not breaker.ready():
+            raise RuntimeError(f"Circuit breaker {breaker.state}")
+        async with self._request_slot():
+            await self.rate_limiter.acquire()
+            if not breaker.allow():
+                raise RuntimeError(f"Circuit breaker {breaker.state}")
+            probe = breaker.probing
+            try:
+                resp = await self.session.post(url, json=payload, timeout=timeout)
+            except asyncio.CancelledError:
+                if probe:
+                    breaker.abandon_probe()
+                raise
+            except Exception:
+                breaker.record_failure()
+                raise
+            async with resp:
+                if resp.status != 200:
+                    if resp.status == 429:
+                        breaker.record_success()
+                        self.rate_limiter.on_throttled(parse_retry_after(resp.headers.get("Retry-After")))
+                    elif resp.status >= 500:
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                    try:
+                        error_text = await resp.text()
+                    except Exception:
+                        error_text = ""
+                    raise RuntimeError(f"API returned status {resp.status} {error_text}")
+                breaker.record_success()
+                self.rate_limiter.on_success()
+                async for raw_line in resp.content:
+                    line = raw_line.decode("utf-8", "ignore").strip()
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    try:
+                        delta = json.loads(data)["choices"][0].get("delta", {}).get("content")
+                    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+                        continue
+                    if delta:
+                        yield delta
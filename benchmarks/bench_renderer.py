@@ -0,0 +1,74 @@
+"""Microbenchmark: legacy regex reply pipeline vs. ResponseRenderer on large replies.
+
+Usage: python benchmarks/bench_renderer.py [--size CHARS] [--iterations N]
+"""
+import os
+import re
+import sys
+import random
+import argparse
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from renderer import ResponseRenderer
+
+def legacy_render(response, user_id="123", user_message="write some code"):
+    response = response.strip()
+    response = re.sub(r"\n{3,}", "\n\n", response)
+    cleaned_lines = [line for line in response.split("\n") if not re.match(r"^---", line) and "Generated by" not in line and not re.search(r"\d{4}-\d{2}-\d{2}", line)]
+    content = "\n".join(cleaned_lines).strip()
+    url_pattern = r"https?://\S+"
+    image_urls = re.findall(url_pattern, content)
+    content = re.sub(url_pattern, "", content).strip()
+    prefixed_content = f"<@{user_id}> {content}"
+    sends = []
+    if 'code' in user_message or 'script' in user_message:
+        for lang, code in re.findall(r'\[CODE\]\s*(\w+)\s*([\s\S]*?)\[/CODE\]', prefixed_content, re.DOTALL):
+            sends.append(f"```{lang}\n{code.strip()}\n```")
+        prefixed_content = re.sub(r'\[CODE\][\s\S]*?\[/CODE\]', '', prefixed_content).strip()
+    sends.append(prefixed_content)
+    return sends, image_urls
+
+def new_render(renderer, response, user_id="123"):
+    parsed = renderer.parse(renderer.clean(response))
+    return renderer.pack(parsed["blocks"], f"<@{user_id}>"), parsed["image_urls"]
+
+def make_response(size, seed=0):
+    rng = random.Random(seed)
+    words = ["unity", "discord", "model", "memory", "channel", "image", "reply", "stream", "token", "python"]
+    parts = []
+    length = 0
+    while length < size:
+        kind = rng.random()
+        if kind < 0.6:
+            part = " ".join(rng.choice(words) for _ in range(rng.randint(20, 120)))
+        elif kind < 0.85:
+            body = "\n".join(f"value_{i} = compute({i}, '{rng.choice(words)}')" for i in range(rng.randint(5, 60)))
+            part = f"[CODE] python\n{body}\n[/CODE]"
+        else:
+            part = f"https://image.pollinations.ai/prompt/{rng.choice(words)}?seed={rng.randint(100000, 999999)}"
+        parts.append(part)
+        length += len(part) + 2
+    return "\n\n".join(parts)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=20000, help="approximate reply length in characters")
+    parser.add_argument("--iterations", type=int, default=500)
+    args = parser.parse_args()
+
+    renderer = ResponseRenderer(file_threshold=args.size * 2)
+    response = make_response(args.size)
+    (messages, _), urls = new_render(renderer, response)
+    legacy_sends, legacy_urls = legacy_render(response)
+    print(f"reply: {len(response)} chars, {len(urls)} urls")
+    print(f"legacy: {len(legacy_sends)} sends, longest {max(len(s) for s in legacy_sends)} chars")
+    print(f"renderer: {len(messages)} messages, longest {max(len(m) for m in messages)} chars")
+
+    for name, fn in (("legacy", lambda: legacy_render(response)), ("renderer", lambda: new_render(renderer, response))):
+        best = min(timeit.repeat(fn, number=args.iterations, repeat=5)) / args.iterations
+        print(f"{name:>9}: {best * 1e6:9.1f} us/reply")
+
+if __name__ == "__main__":
+    main()
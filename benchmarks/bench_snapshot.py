@@ -0,0 +1,108 @@
+"""Benchmark: chat_data.json vs. the compact snapshot format on generated chat data.
+
+Usage: python benchmarks/bench_snapshot.py [--guilds N] [--users N] [--channels N] [--messages N]
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from snapshot_store import Snapshot, convert, guild_section, USER_KEYS
+
+WORDS = ["unity", "discord", "model", "memory", "channel", "image", "reply", "stream", "token", "python", "the", "a", "is"]
+
+def make_data(guilds, users, channels, messages, seed=0):
+    rng = random.Random(seed)
+    start = datetime.datetime(2024, 1, 1)
+
+    def history(user_id, count):
+        return [
+            {
+                "role": "user" if i % 2 == 0 else "assistant",
+                "content": " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 60))),
+                "user_id": user_id,
+                "timestamp": str(start + datetime.timedelta(seconds=rng.randint(0, 10 ** 7))),
+                "status": "active",
+            }
+            for i in range(count)
+        ]
+
+    data = {"channels": {}, **{key: {} for key in USER_KEYS}}
+    for g in range(guilds):
+        guild_id = str(10 ** 17 + g)
+        for u in range(users):
+            user_id = str(2 * 10 ** 17 + g * users + u)
+            data["user_models"].setdefault(guild_id, {})[user_id] = "unity"
+            data["user_histories"].setdefault(guild_id, {})[user_id] = history(user_id, messages)
+            data["user_model_histories"].setdefault(guild_id, {})[user_id] = {"unity": history(user_id, messages)}
+        for c in range(channels):
+            data["channels"][str(3 * 10 ** 17 + g * channels + c)] = {"memories": [], "history": history("0", messages)}
+    return data
+
+def measure(fn):
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+def load_json(path):
+    with open(path, "r") as f:
+        return json.loads(f.read())
+
+def read_all(path):
+    snapshot = Snapshot(path)
+    try:
+        return snapshot.to_data()
+    finally:
+        snapshot.close()
+
+def read_guild(path, guild_id):
+    snapshot = Snapshot(path)
+    try:
+        return snapshot.read(guild_section(guild_id))
+    finally:
+        snapshot.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--guilds", type=int, default=200)
+    parser.add_argument("--users", type=int, default=10, help="users per guild")
+    parser.add_argument("--channels", type=int, default=3, help="channels per guild")
+    parser.add_argument("--messages", type=int, default=20, help="messages per history")
+    args = parser.parse_args()
+
+    data = make_data(args.guilds, args.users, args.channels, args.messages)
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = os.path.join(tmp, "chat_data.json")
+        with open(json_path, "w") as f:
+            json.dump(data, f, indent=4)
+        del data
+        _, convert_seconds, _ = measure(lambda: convert(json_path, os.path.join(tmp, "chat_data.snap")))
+        convert(json_path, os.path.join(tmp, "chat_data.raw.snap"), compress=False)
+        print(f"{args.guilds} guilds x {args.users} users, {args.channels} channels/guild, {args.messages} messages/history")
+        print(f"converted in {convert_seconds:.2f}s")
+
+        guild_id = str(10 ** 17 + args.guilds // 2)
+        cases = [
+            ("json (indent=4), full load", json_path, load_json),
+            ("snapshot raw, full load", os.path.join(tmp, "chat_data.raw.snap"), read_all),
+            ("snapshot zlib, full load", os.path.join(tmp, "chat_data.snap"), read_all),
+            ("snapshot raw, one guild", os.path.join(tmp, "chat_data.raw.snap"), lambda path: read_guild(path, guild_id)),
+            ("snapshot zlib, one guild", os.path.join(tmp, "chat_data.snap"), lambda path: read_guild(path, guild_id)),
+        ]
+        for name, path, fn in cases:
+            _, elapsed, peak = measure(lambda: fn(path))
+            print(f"{name:>28}: {os.path.getsize(path) / 1e6:8.2f} MB on disk, {elapsed * 1e3:9.1f} ms, peak {peak / 1e6:8.2f} MB")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+"""Offline load test: drive bot.on_message with synthetic messages against a local stub API.
+
+Runs the real bot wiring (scheduler, memory, storage, API client, renderer) in a
+scratch directory, with Discord replaced by fake messages/channels and
+Pollinations replaced by an aiohttp stub that injects latency, 429s and 5xx.
+Config still comes from the environment, so e.g. API_RATE_LIMIT=2 measures
+the bot under request pacing. Per-user/per-guild admission limits are
+off unless ADMISSION_* variables are set; rejected messages are counted separately.
+
+Usage: python benchmarks/load_test.py [--messages N] [--rate MSGS_PER_SEC] [--guilds G]
+       [--channels C] [--users U] [--latency SEC] [--throttle-rate P] [--error-rate P]
+"""
+import os
+import sys
+import json
+import random
+import shutil
+import asyncio
+import logging
+import argparse
+import tempfile
+import itertools
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 512
+WORDS = ["unity", "discord", "model", "memory", "channel", "image", "reply", "stream", "token", "python"]
+
+class StubServer:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.stats = {"completions": 0, "throttled": 0, "errors": 0, "images": 0, "models": 0}
+        self.runner = None
+        self.base_url = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/models", self.models)
+        app.router.add_post("/openai", self.completion)
+        app.router.add_get("/image/{name}", self.image)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}"
+
+    async def close(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+    async def models(self, request):
+        self.stats["models"] += 1
+        return web.json_response([{"name": "unity", "description": "Stub model"}, {"name": "openai", "description": "Stub model"}])
+
+    async def image(self, request):
+        self.stats["images"] += 1
+        return web.Response(body=PNG, content_type="image/png")
+
+    def _reply(self):
+        parts = []
+        while sum(len(p) for p in parts) < self.args.reply_chars:
+            if self.rng.random() < 0.2:
+                body = "\n".join(f"x_{i} = {i}" for i in range(self.rng.randint(3, 20)))
+                parts.append(f"[CODE] python\n{body}\n[/CODE]")
+            else:
+                parts.append(" ".join(self.rng.choice(WORDS) for _ in range(self.rng.randint(10, 60))))
+        if self.rng.random() < self.args.image_rate:
+            parts.append(f"{self.base_url}/image/{self.rng.randint(0, 9)}.png")
+        return "\n\n".join(parts)
+
+    async def completion(self, request):
+        payload = await request.json()
+        await asyncio.sleep(self.rng.lognormvariate(0, 0.5) * self.args.latency)
+        roll = self.rng.random()
+        if roll < self.args.throttle_rate:
+            self.stats["throttled"] += 1
+            return web.Response(status=429, text="rate limited", headers={"Retry-After": str(self.args.retry_after)})
+        if roll < self.args.throttle_rate + self.args.error_rate:
+            self.stats["errors"] += 1
+            return web.Response(status=self.rng.choice([500, 502, 503]), text="upstream error")
+        self.stats["completions"] += 1
+        text = self._reply()
+        if not payload.get("stream"):
+            return web.json_response({"choices": [{"message": {"role": "assistant", "content": text}}]})
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for i in range(0, len(text), 40):
+            chunk = json.dumps({"choices": [{"delta": {"content": text[i:i + 40]}}]})
+            await response.write(f"data: {chunk}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+class FakeUser:
+    def __init__(self, user_id, bot=False):
+        self.id = user_id
+        self.bot = bot
+        self.name = f"user{user_id}"
+        self.mention = f"<@{user_id}>"
+
+class FakeGuild:
+    def __init__(self, guild_id, shard_id=0):
+        self.id = guild_id
+        self.shard_id = shard_id
+
+class FakeSentMessage:
+    def __init__(self, channel, content):
+        self.channel = channel
+        self.content = content
+
+    async def edit(self, content=None, **kwargs):
+        self.content = content
+
+    async def delete(self):
+        pass
+
+class FakeChannel:
+    def __init__(self, channel_id, guild):
+        self.id = channel_id
+        self.guild = guild
+        self.sent = 0
+        self.errors = 0
+
+    async def send(self, content=None, files=None, **kwargs):
+        self.sent += 1
+        if content and ("Error" in content or "Something went wrong" in content):
+            self.errors += 1
+        return FakeSentMessage(self, content)
+
+class FakeMessage:
+    _ids = itertools.count(1)
+
+    def __init__(self, channel, author, content):
+        self.id = next(self._ids)
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self._state = None
+        self.attachments = []
+        self.mentions = []
+
+def percentile(samples, q):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+def histogram(samples, width=40):
+    if not samples:
+        return []
+    bounds = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf")]
+    counts = [0] * len(bounds)
+    for sample in samples:
+        counts[next(i for i, bound in enumerate(bounds) if sample <= bound)] += 1
+    peak = max(counts)
+    lines = []
+    for bound, count in zip(bounds, counts):
+        if count:
+            label = "inf" if bound == float("inf") else f"{bound:g}s"
+            lines.append(f"  <= {label:>6} {count:6d} {'#' * max(1, round(count / peak * width))}")
+    return lines
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+        scale = 1 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+async def sample_loop_lag(samples, interval=0.05):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - started - interval)
+
+def load_bot(workdir, stub_url):
+    shutil.copy(os.path.join(ROOT, "system_instructions.txt"), workdir)
+    os.chdir(workdir)
+    os.environ["DISCORD_TOKEN"] = "x" * 59
+    os.environ["POLLINATIONS_TOKEN"] = "LoadTestToken000"
+    import bot as bot_module
+    from router import EndpointRouter
+    bot_module.log_pipeline.console.setLevel(logging.ERROR)
+    config = bot_module.config
+    config.api_url = f"{stub_url}/openai"
+    config.api_urls = [config.api_url]
+    config.models_url = f"{stub_url}/models"
+    bot_module.api_client.router = EndpointRouter(config.api_urls, config.model_fallbacks, config.hedge_delay)
+    bot_module.bot._connection.user = FakeUser(1)
+    return bot_module
+
+async def run(args):
+    stub = StubServer(args)
+    await stub.start()
+    workdir = tempfile.mkdtemp(prefix="unity-load-")
+    bot_module = load_bot(workdir, stub.base_url)
+    bot = bot_module.bot
+
+    await bot_module.start_setup()
+
+    loop = asyncio.get_running_loop()
+    latencies = []
+    finished = asyncio.Event()
+    outstanding = 0
+    process_message = bot_module.process_message
+
+    submitted_at = {}
+
+    async def timed_process(message, earlier=()):
+        nonlocal outstanding
+        try:
+            await process_message(message, earlier)
+        finally:
+            for done in (*earlier, message):
+                latencies.append(loop.time() - submitted_at.pop(done.id))
+                outstanding -= 1
+            if outstanding == 0 and submitted_all:
+                finished.set()
+
+    rng = random.Random(args.seed)
+    guilds = [FakeGuild(1000 + g) for g in range(args.guilds)]
+    channels = [FakeChannel(10000 + g * args.channels + c, guild) for g, guild in enumerate(guilds) for c in range(args.channels)]
+    users = {channel.id: [FakeUser(100000 + channel.id * args.users + u) for u in range(args.users)] for channel in channels}
+
+    lag = []
+    lag_task = asyncio.create_task(sample_loop_lag(lag))
+    rss_start = rss_bytes()
+    submitted_all = False
+    bot_module.process_message = timed_process
+    started = loop.time()
+    for i in range(args.messages):
+        channel = rng.choice(channels)
+        author = rng.choice(users[channel.id])
+        message = FakeMessage(channel, author, " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 30))))
+        submitted_at[message.id] = loop.time()
+        outstanding += 1
+        rejected = bot_module.admission.stats["rejected"]
+        await bot_module.on_message(message)
+        if bot_module.admission.stats["rejected"] > rejected:
+            submitted_at.pop(message.id)
+            outstanding -= 1
+        if args.rate > 0:
+            await asyncio.sleep(rng.expovariate(args.rate))
+    submitted_all = True
+    submit_time = loop.time() - started
+    if outstanding:
+        try:
+            await asyncio.wait_for(finished.wait(), timeout=args.timeout)
+        except asyncio.TimeoutError:
+            print(f"timed out with {outstanding} messages still queued")
+    elapsed = loop.time() - started
+    rss_end = rss_bytes()
+    lag_task.cancel()
+    bot_module.process_message = process_message
+
+    await bot_module.scheduler.close()
+    await bot_module.model_catalog.close()
+    await bot_module.message_handler.summarizer.close()
+    await bot_module.data_manager.close(bot_module.memory_manager)
+    await bot_module.message_handler.image_fetcher.close()
+    await bot_module.api_client.close()
+    await stub.close()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    api_client = bot_module.api_client
+    print(f"load: {args.messages} messages over {args.guilds} guilds x {args.channels} channels x {args.users} users, submitted in {submit_time:.2f}s")
+    print(f"completed: {len(latencies)} in {elapsed:.2f}s ({len(latencies) / elapsed:.1f} msg/s), "
+          f"{sum(c.sent for c in channels)} sends, {sum(c.errors for c in channels)} error replies")
+    print(f"latency: p50 {percentile(latencies, 0.5):.3f}s  p90 {percentile(latencies, 0.9):.3f}s  "
+          f"p99 {percentile(latencies, 0.99):.3f}s  max {max(latencies, default=0):.3f}s")
+    for line in histogram(latencies):
+        print(line)
+    print(f"loop lag: p50 {percentile(lag, 0.5) * 1000:.1f}ms  p99 {percentile(lag, 0.99) * 1000:.1f}ms  max {max(lag, default=0) * 1000:.1f}ms")
+    print(f"rss: {rss_start / 2**20:.1f} MiB -> {rss_end / 2**20:.1f} MiB ({(rss_end - rss_start) / 2**20:+.1f} MiB)")
+    print(f"stub: {stub.stats}")
+    print(f"rate limiter: {api_client.rate_limiter.snapshot()}")
+    print(f"breakers: {api_client.breaker_snapshot()}")
+    print(f"response cache: {api_client.response_cache.snapshot()}")
+    print(f"admission: {bot_module.admission.snapshot()}")
+    if bot_module.debouncer is not None:
+        print(f"debouncer: {bot_module.debouncer.stats}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--rate", type=float, default=50, help="mean arrivals per second (0 submits everything at once)")
+    parser.add_argument("--guilds", type=int, default=5)
+    parser.add_argument("--channels", type=int, default=4, help="channels per guild")
+    parser.add_argument("--users", type=int, default=10, help="users per channel")
+    parser.add_argument("--latency", type=float, default=0.2, help="median stub completion latency in seconds")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of completions answered with 429")
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of completions answered with 5xx")
+    parser.add_argument("--reply-chars", type=int, default=600)
+    parser.add_argument("--image-rate", type=float, default=0.0, help="fraction of replies that link a stub image")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds to wait for the queue to drain")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
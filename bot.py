@@ -1,84 +1,225 @@
+import time
+process_started = time.perf_counter()
 import discord
 from discord.ext import commands
 import asyncio
 import os
 import logging
-import aiofiles
 from config import Config
 from api_client import APIClient
 from message_handler import MessageHandler
 from memory_manager import MemoryManager
 from commands import setup_commands
-from data_manager import DataManager
+from model_catalog import ModelCatalog
+from data_manager import create_data_manager
+from scheduler import MessageScheduler
+from metrics import registry, MetricsServer
+from log_pipeline import LogPipeline
+from startup import StartupProfile
+from admission import AdmissionController, REJECTION_MESSAGES
+from debouncer import MessageDebouncer
 
 if not os.path.exists("logs"):
     os.makedirs("logs")
-logging.basicConfig(filename="logs/application.log", level=logging.DEBUG, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-console = logging.StreamHandler()
-console.setLevel(logging.INFO)
-console.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
-logging.getLogger("").addHandler(console)
+log_pipeline = LogPipeline("logs/application.log")
+startup = StartupProfile(process_started)
+
+try:
+    config = Config()
+except Exception:
+    # Flush with default settings so configuration errors still reach the console and log file
+    log_pipeline.configure()
+    raise
+log_pipeline.configure(
+    filename=config.log_filename,
+    fmt=config.log_format,
+    level=config.log_level,
+    max_bytes=config.log_max_bytes,
+    when=config.log_rotate_when,
+    backup_count=config.log_backup_count,
+    compress=config.log_compress,
+    bodies=config.log_message_bodies,
+    body_max_chars=config.log_body_max_chars,
+)
 
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix="!", intents=intents)
+if config.sharding or config.shard_ids is not None:
+    bot = commands.AutoShardedBot(command_prefix="!", intents=intents, shard_ids=config.shard_ids, shard_count=config.shard_count)
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents)
+
+SHARD_MESSAGES = registry.counter("unity_shard_messages_total", "Messages received per gateway shard", ["shard"])
+SHARD_LATENCY = registry.gauge("unity_shard_latency_seconds", "Gateway heartbeat latency per shard", ["shard"])
+SHARD_GUILDS = registry.gauge("unity_shard_guilds", "Guilds served per shard", ["shard"])
+
+def shard_latencies():
+    return {(shard_id,): latency for shard_id, latency in getattr(bot, "latencies", [(0, bot.latency)])}
+
+def shard_guilds():
+    counts = {}
+    for guild in bot.guilds:
+        counts[(guild.shard_id,)] = counts.get((guild.shard_id,), 0) + 1
+    return counts
+
+SHARD_LATENCY.set_function(shard_latencies)
+SHARD_GUILDS.set_function(shard_guilds)
 
-config = Config()
 api_client = APIClient(config)
-memory_manager = MemoryManager()
-data_manager = DataManager("logs/chat_data.json")
+memory_manager = MemoryManager(config.max_history, config.max_memories)
+data_manager = create_data_manager(config, "logs/chat_data.json")
 bot.data_manager = data_manager
+scheduler = MessageScheduler()
+bot.scheduler = scheduler
+admission = AdmissionController(config)
+metrics_server = MetricsServer(registry, config.metrics_host, config.metrics_port)
 message_handler = MessageHandler(api_client, memory_manager, config, data_manager, bot)
+
+def submit_batch(messages):
+    scheduler.submit(messages[-1].channel.id, lambda: process_admitted(messages[-1], messages[:-1]))
+
+debouncer = MessageDebouncer(config.debounce_window, submit_batch) if config.debounce_window > 0 else None
+message_handler.debouncer = debouncer
 memory_manager.api_client = api_client
 bot.memory_manager = memory_manager
+model_catalog = ModelCatalog(api_client, memory_manager, "logs/models.json", config.model_catalog_ttl)
+setup_task = None
+buffered_messages = 0
 
-async def setup_bot():
-    await bot.wait_until_ready()
-    models = await api_client.fetch_models()
-    if not models:
-        models = [{"name": "unity", "description": "Default unity model"}]
-        logging.info("No models loaded from API, defaulting to 'unity'.")
-    memory_manager.set_models(models)
-    config.default_model = "unity"
-    data_manager.load_data(memory_manager)
-    setup_commands(bot, models)
+async def load_state():
+    with startup.phase("load_state"):
+        await data_manager.flush(memory_manager)
+        # Parsing chat_data.json can take a while; a worker thread keeps the gateway handshake going meanwhile
+        await asyncio.get_running_loop().run_in_executor(None, data_manager.load_data, memory_manager)
+        data_manager.attach(memory_manager)
+        data_manager.start()
+    if config.memory_idle_ttl > 0 or config.memory_max_entries > 0 or config.memory_max_bytes > 0:
+        if data_manager.backend in ("json", "journal"):
+            logging.warning(f"Evicted chat data stays in memory (compressed) with STORAGE_BACKEND={data_manager.backend}; use sqlite, snapshot or partitioned to free it")
+        asyncio.create_task(evict_idle_periodically())
+
+async def warm_models():
+    with startup.phase("models"):
+        models = model_catalog.load()
+        model_catalog.start()
     print(f"Loaded {len(models)} models: {[m['name'] for m in models]}")
 
+async def setup_bot():
+    with startup.phase("setup"):
+        config.default_model = "unity"
+        setup_commands(bot)
+        await asyncio.gather(load_state(), warm_models())
+        # Not before: a scrape walks memory_manager's dicts, which the loader thread fills in meanwhile
+        await metrics_server.start()
+    startup.log("state ready")
+    return True
+
+# State loads while the gateway connects; messages wait in their channel queue until it is ready
+def start_setup():
+    global setup_task
+    if setup_task is None:
+        setup_task = asyncio.ensure_future(setup_bot())
+    return setup_task
+
+bot.start_setup = start_setup
+
+@bot.event
+async def on_connect():
+    await api_client.initialize()
+    startup.mark("gateway_connected")
+    print("Bot connected to Discord")
+
 @bot.event
 async def on_ready():
     print(f"{bot.user} has connected to Discord!")
     logging.info("Bot is ready and connected.")
-    await setup_bot()
-    asyncio.create_task(wipe_logs_periodically())
-    asyncio.create_task(check_for_updates_periodically())
+    # on_ready fires again after every reconnect
+    if not startup.mark("gateway_ready"):
+        return
+    await start_setup()
+    startup.log("gateway ready")
+    if config.shard_ids is None or 0 in config.shard_ids:
+        # Only one shard process checks for updates
+        asyncio.create_task(check_for_updates_periodically())
+
+@bot.event
+async def on_shard_ready(shard_id):
+    logging.info(f"Shard {shard_id} is ready")
 
 @bot.event
 async def on_message(message):
     if message.author == bot.user:
         return
+    SHARD_MESSAGES.inc(shard=message.guild.shard_id if message.guild else 0)
     if message.guild and config.allowed_channels and str(message.channel.id) not in config.allowed_channels:
         logging.info(
             f"Ignoring message in unauthorized channel {message.channel.id}"
         )
         return
 
+    # Commands skip admission; everything else must pass it before it is queued
+    if not message.content.startswith(bot.command_prefix):
+        guild_id = str(message.guild.id) if message.guild else "DM"
+        user_id = str(message.author.id)
+        reason = admission.admit(guild_id, user_id)
+        if reason is not None:
+            logging.info(f"Rejected message from {user_id} in guild {guild_id} ({reason})")
+            if admission.should_notify(user_id):
+                try:
+                    await message.channel.send(f"<@{user_id}> {REJECTION_MESSAGES[reason]}")
+                except Exception as e:
+                    logging.error(f"Failed to send busy reply to user {user_id}: {e}")
+            return
+        if debouncer is not None and not message.author.bot:
+            debouncer.add(message)
+            return
+        job = lambda: process_admitted(message)
+    else:
+        job = lambda: process_message(message)
+
+    delay = 0
     if message.author.bot:
-        logging.info(f"Delaying response to bot {message.author.id} by 10 seconds")
-        await asyncio.sleep(10)
+        delay = config.bot_reply_delay
+        logging.info(f"Delaying response to bot {message.author.id} by {delay:g} seconds")
+    scheduler.submit(message.channel.id, job, delay=delay)
+    logging.debug(f"Queued message for channel {message.channel.id} (depth: {scheduler.depth(message.channel.id)})")
+
+async def process_admitted(message, earlier=()):
+    try:
+        await process_message(message, earlier)
+    finally:
+        admission.release(len(earlier) + 1)
 
+async def process_message(message, earlier=()):
+    global buffered_messages
     channel_id = str(message.channel.id)
     guild_id = str(message.guild.id) if message.guild else "DM"
     user_id = str(message.author.id)
-    logging.info(f"Received message from {user_id} in channel {channel_id} (guild: {guild_id}): {message.content}")
+    logging.info(f"Received message from {user_id} in channel {channel_id} (guild: {guild_id})", extra={"body": message.content})
+    if earlier:
+        logging.info(f"Answering {len(earlier) + 1} messages from {user_id} in channel {channel_id} together")
+
+    setup = start_setup()
+    if not setup.done():
+        buffered_messages += 1
+        logging.info(f"Holding message from {user_id} until state is loaded ({buffered_messages} waiting so far)")
+    await setup
 
+    await memory_manager.preload(channel_id, guild_id, user_id)
     memory_manager.initialize_channel(channel_id)
     user_model = memory_manager.get_user_model(guild_id, user_id)
     logging.info(f"User {user_id} using model: {user_model} in guild {guild_id}")
 
     try:
         await bot.process_commands(message)
-        await message_handler.handle_message(message)
+        if not message.content.startswith(bot.command_prefix):
+            async with admission.slot(admission.guild_key(guild_id, user_id)):
+                await message_handler.handle_message(message, earlier)
+        else:
+            await message_handler.handle_message(message)
         await data_manager.save_data_async(memory_manager)
+        if startup.mark("first_reply"):
+            startup.log(f"first reply, {buffered_messages} messages held during startup")
     except Exception as e:
         logging.error(f"Error handling message for user {user_id}: {e}")
         try:
@@ -86,9 +227,6 @@ async def on_message(message):
         except Exception as send_error:
             logging.error(f"Failed to send error message to user {user_id}: {send_error}")
 
-    if len(memory_manager.channel_histories.get(channel_id, [])) > config.max_history:
-        memory_manager.channel_histories[channel_id] = memory_manager.channel_histories[channel_id][-config.max_history:]
-
 @bot.command(name="wipe")
 async def wipe(ctx):
     try:
@@ -97,14 +235,7 @@ async def wipe(ctx):
         user_id = str(ctx.author.id)
         logging.info(f"Wipe command initiated by {user_id} in channel {channel_id}")
 
-        bot.memory_manager.channel_histories[channel_id] = []
-        if guild_id in bot.memory_manager.user_histories:
-            if user_id in bot.memory_manager.user_histories[guild_id]:
-                bot.memory_manager.user_histories[guild_id][user_id] = []
-        if guild_id in bot.memory_manager.user_model_histories:
-            if user_id in bot.memory_manager.user_model_histories[guild_id]:
-                for model in bot.memory_manager.user_model_histories[guild_id][user_id]:
-                    bot.memory_manager.user_model_histories[guild_id][user_id][model] = []
+        bot.memory_manager.wipe_user(channel_id, guild_id, user_id)
 
         await bot.data_manager.save_data_async(bot.memory_manager)
         await ctx.send(f"<@{user_id}> Chat history wiped for this server.")
@@ -113,17 +244,20 @@ async def wipe(ctx):
         logging.error(f"Error in wipe command for user {user_id}: {e}")
         await ctx.send(f"<@{user_id}> Error wiping chat history: {str(e)}")
 
-async def wipe_logs_periodically():
+async def evict_idle_periodically():
     while True:
         try:
-            await asyncio.sleep(3600)
-            async with aiofiles.open("logs/application.log", "w") as f:
-                await f.write("")
-            logging.info("Logs wiped successfully.")
+            await asyncio.sleep(config.eviction_interval)
+            # Write out pending changes first so evicted state reloads intact
+            await data_manager.flush(memory_manager)
+            evicted = memory_manager.evict_idle(config.memory_idle_ttl, config.memory_max_entries, config.memory_max_bytes)
+            if evicted:
+                message_handler.context_builder.prune()
+                logging.info(f"Evicted {evicted} idle channels/users; {len(memory_manager.access)} resident, {len(memory_manager.evicted)} evicted")
         except asyncio.CancelledError:
             break
         except Exception as e:
-            logging.error(f"Error wiping logs: {e}")
+            logging.error(f"Error evicting idle state: {e}")
 
 async def check_for_updates_periodically():
     while True:
@@ -172,17 +306,14 @@ async def check_for_updates_periodically():
         except Exception as e:
             logging.error(f"Error checking for updates: {e}")
 
-@bot.event
-async def on_connect():
-    await api_client.initialize()
-    print("Bot connected to Discord")
-
 @bot.event
 async def on_disconnect():
     await api_client.close()
     print("Bot disconnected from Discord")
 
 async def main():
+    startup.mark("init")
+    start_setup()
     try:
         await bot.start(config.discord_token)
     except discord.errors.LoginFailure as e:
@@ -192,9 +323,18 @@ async def main():
         logging.error(f"Unexpected error: {e}")
         print(f"Unexpected error: {e}")
     finally:
+        if debouncer is not None:
+            debouncer.close()
+        await scheduler.close()
+        await metrics_server.close()
+        await model_catalog.close()
+        await message_handler.summarizer.close()
+        await data_manager.close(memory_manager)
+        await message_handler.image_fetcher.close()
         await api_client.close()
         if not bot.is_closed():
             await bot.close()
+        log_pipeline.stop()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -1,38 +1,41 @@
 import discord
 from discord.ext import commands
-from discord.ui import View, Button
+from discord.ui import View, Button, DynamicItem
 from discord import ButtonStyle
 import asyncio
 import logging
+from metrics import registry
 
-class ModelSelectView(View):
-    def __init__(self, models, user_id, guild_id, memory_manager, data_manager):
-        super().__init__(timeout=60)
-        self.models = models
-        self.user_id = user_id
+# Button state lives in the custom_id so any shard process can handle the click; DM interactions
+# always arrive on shard 0, which may not be the process that sent the picker
+class ModelButton(DynamicItem[Button], template=r"unity:model:(?P<guild_id>[^:]+):(?P<user_id>\d+):(?P<model>.+)"):
+    def __init__(self, guild_id, user_id, model_name):
+        super().__init__(Button(label=model_name, style=ButtonStyle.grey, custom_id=f"unity:model:{guild_id}:{user_id}:{model_name}"))
         self.guild_id = guild_id
-        self.memory_manager = memory_manager
-        self.data_manager = data_manager
-        for model in self.models:
-            button = Button(label=model["name"], style=ButtonStyle.grey)
-            button.callback = self.create_callback(model["name"])
-            self.add_item(button)
+        self.user_id = user_id
+        self.model_name = model_name
 
-    def create_callback(self, model_name):
-        async def callback(interaction):
-            await self.select_model(interaction, model_name)
-        return callback
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(match["guild_id"], match["user_id"], match["model"])
 
-    async def select_model(self, interaction, model_name):
+    async def callback(self, interaction):
         if str(interaction.user.id) != str(self.user_id):
             await interaction.response.send_message("Only the command issuer can select a model!", ephemeral=True)
             return
 
         await interaction.response.defer()
+        # Persistent buttons can be clicked while state is still loading after a restart
+        await interaction.client.start_setup()
 
-        if self.memory_manager.set_user_model(self.guild_id, self.user_id, model_name):
-            self.memory_manager.user_model_histories.setdefault(self.guild_id, {}).setdefault(self.user_id, {})[model_name] = []
-            await self.data_manager.save_data_async(self.memory_manager)
+        memory_manager = interaction.client.memory_manager
+        data_manager = interaction.client.data_manager
+        model_name = self.model_name
+        # Clicks don't go through process_message, so nothing has loaded this user yet
+        await memory_manager.preload_user(self.guild_id, self.user_id)
+        if memory_manager.set_user_model(self.guild_id, self.user_id, model_name):
+            memory_manager.reset_user_model_history(self.guild_id, self.user_id, model_name)
+            await data_manager.save_data_async(memory_manager)
 
             embed = discord.Embed(
                 title="Model Selected",
@@ -41,9 +44,9 @@ class ModelSelectView(View):
                 timestamp=discord.utils.utcnow()
             )
 
-            for child in self.children:
+            for child in self.view.children:
                 child.disabled = True
-            await interaction.followup.send(embed=embed, view=self, ephemeral=True)
+            await interaction.followup.send(embed=embed, view=self.view, ephemeral=True)
         else:
             embed = discord.Embed(
                 title="Invalid Model",
@@ -51,7 +54,19 @@ class ModelSelectView(View):
                 color=0xff0000,
                 timestamp=discord.utils.utcnow()
             )
-            await interaction.followup.send(embed=embed, view=self, ephemeral=True)
+            await interaction.followup.send(embed=embed, view=self.view, ephemeral=True)
+
+class ModelSelectView(View):
+    def __init__(self, models, user_id, guild_id):
+        super().__init__(timeout=60)
+        self.models = models
+        self.user_id = user_id
+        self.guild_id = guild_id
+        for model in self.models:
+            if len(f"unity:model:{guild_id}:{user_id}:{model['name']}") > 100:
+                logging.warning(f"Model name {model['name']} is too long for a button; skipping")
+                continue
+            self.add_item(ModelButton(guild_id, user_id, model["name"]))
 
     async def on_timeout(self):
         for child in self.children:
@@ -61,7 +76,10 @@ class ModelSelectView(View):
         except Exception as e:
             logging.error("Failed to edit message on timeout", exc_info=e)
 
-def setup_commands(bot, models):
+# Commands read bot.memory_manager.models on each call, so catalog refreshes show up without re-registering
+def setup_commands(bot):
+    bot.add_dynamic_items(ModelButton)
+
     @bot.command(name="unityhelp")
     async def unityhelp(ctx):
         embed = discord.Embed(
@@ -70,6 +88,7 @@ def setup_commands(bot, models):
             color=0x00ff00,
             timestamp=discord.utils.utcnow()
         )
+        models = bot.memory_manager.models
         embed.add_field(
             name="Commands",
             value="`!unityhelp` - Show this help\n`!setmodel` - Choose a model\n`!savememory <text>` - Save a memory\n`!wipe` - Clear chat history",
@@ -87,6 +106,7 @@ def setup_commands(bot, models):
     async def setmodel(ctx):
         user_id = str(ctx.author.id)
         guild_id = str(ctx.guild.id) if ctx.guild else "DM"
+        models = bot.memory_manager.models
         if not models:
             embed = discord.Embed(
                 title="No Models Available",
@@ -113,7 +133,7 @@ def setup_commands(bot, models):
                     color=0x3498db,
                     timestamp=discord.utils.utcnow()
                 )
-                view = ModelSelectView(chunk, user_id, guild_id, bot.memory_manager, bot.data_manager)
+                view = ModelSelectView(chunk, user_id, guild_id)
                 message = await dm_channel.send(embed=embed, view=view)
                 view.message = message
         except discord.Forbidden:
@@ -132,4 +152,26 @@ def setup_commands(bot, models):
             color=0x00ff00,
             timestamp=discord.utils.utcnow()
         )
-        await ctx.send(f"<@{user_id}>", embed=embed)
\ No newline at end of file
+        await ctx.send(f"<@{user_id}>", embed=embed)
+
+    @bot.command(name="stats")
+    @commands.check_any(commands.is_owner(), commands.has_permissions(administrator=True))
+    async def stats(ctx):
+        embed = discord.Embed(
+            title="Unity Stats",
+            color=0x3498db,
+            timestamp=discord.utils.utcnow()
+        )
+        for name, rows in list(registry.summary().items())[:25]:
+            value = "\n".join(rows)
+            embed.add_field(name=name, value=value if len(value) <= 1024 else value[:1021] + "...", inline=False)
+        if not embed.fields:
+            embed.description = "No metrics recorded yet."
+        await ctx.send(embed=embed)
+
+    @stats.error
+    async def stats_error(ctx, error):
+        if isinstance(error, commands.CheckFailure):
+            await ctx.send(f"<@{ctx.author.id}> Only server administrators can use !stats.")
+        else:
+            logging.error(f"Error in stats command: {error}")
@@ -63,8 +63,124 @@ class Config:
             raise FileNotFoundError("system_instructions.txt not found")
         self.api_url = f"https://text.pollinations.ai/openai?token={self.pollinations_token}"
         self.models_url = "https://text.pollinations.ai/models"
+        # Extra completion endpoints to fail over or hedge to; "{token}" is replaced with the Pollinations token
+        self.api_urls = [self.api_url] + [
+            url.strip().replace("{token}", self.pollinations_token)
+            for url in os.getenv("API_URLS", "").split(",") if url.strip()
+        ]
+        # Per-model fallbacks, e.g. "unity:openai|mistral,evil:openai"
+        self.model_fallbacks = {}
+        for entry in os.getenv("MODEL_FALLBACKS", "").split(","):
+            if ":" in entry:
+                model, fallbacks = entry.split(":", 1)
+                self.model_fallbacks[model.strip().lower()] = [f.strip() for f in fallbacks.split("|") if f.strip()]
+        # Send a duplicate to the next endpoint/fallback once the primary passes its p95 latency
+        self.hedge_requests = os.getenv("HEDGE_REQUESTS", "true").strip().lower() in ("1", "true", "yes")
+        self.hedge_delay = float(os.getenv("HEDGE_DELAY", "10"))
         self.max_history = 20
-        self.max_memories = 5
+        # Seconds a cached model list (logs/models.json) is used before it is refreshed in the background
+        self.model_catalog_ttl = float(os.getenv("MODEL_CATALOG_TTL", "3600"))
+        # Saved memories kept per channel; prompts carry only the MEMORY_TOP_K best matches for the incoming
+        # message (BM25), within MEMORY_TOKEN_BUDGET approximate tokens
+        self.max_memories = int(os.getenv("MAX_MEMORIES", "5000"))
+        self.memory_top_k = int(os.getenv("MEMORY_TOP_K", "5"))
+        self.memory_token_budget = int(os.getenv("MEMORY_TOKEN_BUDGET", "600"))
+        # Approximate token budget (~4 chars/token) for system prompt, memories and history
+        self.context_token_budget = int(os.getenv("CONTEXT_TOKEN_BUDGET", "4000"))
+        # Once a user's history with a model has SUMMARY_THRESHOLD turns past its summary, all but the newest
+        # SUMMARY_KEEP_TURNS are summarized in the background (0, the default, disables); summaries are paced separately
+        # from replies at SUMMARY_RATE_LIMIT requests per second and don't use the reply slots or breakers
+        self.summary_threshold = int(os.getenv("SUMMARY_THRESHOLD", "0"))
+        self.summary_keep_turns = int(os.getenv("SUMMARY_KEEP_TURNS", "4"))
+        self.summary_rate_limit = float(os.getenv("SUMMARY_RATE_LIMIT", "0.2"))
+        self.summary_max_words = int(os.getenv("SUMMARY_MAX_WORDS", "150"))
+        self.summary_model = os.getenv("SUMMARY_MODEL", "").strip()
+        # Channels/users untouched for MEMORY_IDLE_TTL seconds are dropped from memory (0, the default, keeps them)
+        # and reloaded from storage when next used; MEMORY_MAX_ENTRIES / MEMORY_MAX_BYTES (approximate) cap what
+        # stays resident. Only the sqlite/snapshot/partitioned backends free the memory: json/journal saves rewrite
+        # everything, so they keep evicted entries compressed in memory
+        self.memory_idle_ttl = float(os.getenv("MEMORY_IDLE_TTL", "0"))
+        self.memory_max_entries = int(os.getenv("MEMORY_MAX_ENTRIES", "0"))
+        self.memory_max_bytes = int(os.getenv("MEMORY_MAX_BYTES", "0"))
+        self.eviction_interval = float(os.getenv("EVICTION_INTERVAL", "60"))
+        # Seconds between coalesced chat_data.json writes; 0 writes on every save
+        self.save_interval = float(os.getenv("SAVE_INTERVAL", "5"))
+        # "json" rewrites chat_data.json; "journal" appends changes and compacts in the background;
+        # "sqlite" keeps state in chat_data.db and loads channels/users on first access; "snapshot" keeps it in
+        # chat_data.snap, whose per-guild sections are decoded on first access (zlib-compressed unless SNAPSHOT_COMPRESS=false);
+        # "partitioned" stores the same sections as files under chat_data/ and only rewrites the ones that changed
+        self.storage_backend = os.getenv("STORAGE_BACKEND", "json").strip().lower()
+        self.snapshot_compress = os.getenv("SNAPSHOT_COMPRESS", "true").strip().lower() in ("1", "true", "yes")
+        self.journal_max_bytes = int(os.getenv("JOURNAL_MAX_BYTES", str(1024 * 1024)))
+        # Stream completions into a placeholder message, editing it at most once per interval
+        self.stream_responses = os.getenv("STREAM_RESPONSES", "false").strip().lower() in ("1", "true", "yes")
+        self.stream_edit_interval = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+        # Upper bound on completion requests in flight at once, across all channels
+        self.max_concurrent_requests = int(os.getenv("MAX_CONCURRENT_REQUESTS", "4"))
+        # Admission control in front of the AI: per-user and per-guild message rates, the number of admitted
+        # messages allowed to be outstanding before new ones get a "busy" reply (all off by default; 0 disables),
+        # and per-guild shares of the request slots, e.g. "123:2,456:0.5"
+        self.admission_user_rate = float(os.getenv("ADMISSION_USER_RATE", "0"))
+        self.admission_user_burst = int(os.getenv("ADMISSION_USER_BURST", "5"))
+        self.admission_guild_rate = float(os.getenv("ADMISSION_GUILD_RATE", "0"))
+        self.admission_guild_burst = int(os.getenv("ADMISSION_GUILD_BURST", "20"))
+        self.admission_max_pending = int(os.getenv("ADMISSION_MAX_PENDING", "0"))
+        self.guild_weights = {}
+        for entry in os.getenv("GUILD_WEIGHTS", "").split(","):
+            if ":" in entry:
+                guild_id, weight = entry.split(":", 1)
+                self.guild_weights[guild_id.strip()] = max(float(weight), 0.01)
+        # Seconds to wait for a user to stop typing before answering all of their recent lines in one reply (0 disables)
+        self.debounce_window = float(os.getenv("DEBOUNCE_WINDOW", "0"))
+        # Seconds to defer replies to other bots
+        self.bot_reply_delay = float(os.getenv("BOT_REPLY_DELAY", "10"))
+        # Shared request pacing for the Pollinations API (0, the default, turns it off); halves on 429, and
+        # Retry-After is honoured either way
+        self.api_rate_limit = float(os.getenv("API_RATE_LIMIT", "0"))
+        self.api_rate_burst = int(os.getenv("API_RATE_BURST", "5"))
+        # Consecutive upstream failures before failing fast, and seconds before probing again
+        self.breaker_failure_threshold = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+        self.breaker_cooldown = float(os.getenv("BREAKER_COOLDOWN", "30"))
+        # Models whose completions may be reused for identical prompts (comma-separated)
+        self.cache_models = {
+            m.strip().lower() for m in os.getenv("CACHE_MODELS", "").split(",") if m.strip()
+        }
+        self.cache_ttl = float(os.getenv("CACHE_TTL", "300"))
+        self.cache_max_entries = int(os.getenv("CACHE_MAX_ENTRIES", "256"))
+        # Image downloads for URLs in replies: size cap, per-reply deadline, pool size and cache size
+        self.image_max_bytes = int(os.getenv("IMAGE_MAX_BYTES", str(8 * 1024 * 1024)))
+        self.image_fetch_timeout = float(os.getenv("IMAGE_FETCH_TIMEOUT", "15"))
+        self.image_fetch_concurrency = int(os.getenv("IMAGE_FETCH_CONCURRENCY", "4"))
+        self.image_cache_max_bytes = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+        # Replies longer than this many characters are uploaded as response.txt instead of split into messages
+        self.render_file_threshold = int(os.getenv("RENDER_FILE_THRESHOLD", "8000"))
+        # SHARDING=auto runs all gateway shards in this process; SHARD_IDS (e.g. "0,1") with SHARD_COUNT runs only
+        # those shards so several processes can split the load (see run_shards.py)
+        self.sharding = os.getenv("SHARDING", "off").strip().lower() == "auto"
+        self.shard_count = int(os.getenv("SHARD_COUNT", "0")) or None
+        self.shard_ids = [int(s) for s in os.getenv("SHARD_IDS", "").split(",") if s.strip()] or None
+        if self.shard_ids is not None and self.shard_count is None:
+            raise ValueError("SHARD_IDS requires SHARD_COUNT to be set")
+        # Shard processes share logs/chat_data.db and pick up each other's changes every STATE_SYNC_INTERVAL seconds
+        self.state_sync_interval = float(os.getenv("STATE_SYNC_INTERVAL", "1"))
+        # Serve Prometheus metrics on http://METRICS_HOST:METRICS_PORT/metrics; 0 disables the endpoint
+        self.metrics_port = int(os.getenv("METRICS_PORT", "0"))
+        self.metrics_host = os.getenv("METRICS_HOST", "127.0.0.1").strip()
+        if self.shard_ids is not None and self.metrics_port:
+            # One port per shard process: METRICS_PORT + the process's first shard id
+            self.metrics_port += self.shard_ids[0]
+        # logs/application.log (application-shard<N>.log in shard processes): "text" or "json" lines, rotated at LOG_MAX_BYTES or on a LOG_ROTATE_WHEN schedule
+        # (e.g. "midnight", "H"), keeping LOG_BACKUP_COUNT gzipped files
+        self.log_filename = "logs/application.log" if self.shard_ids is None else f"logs/application-shard{self.shard_ids[0]}.log"
+        self.log_level = os.getenv("LOG_LEVEL", "DEBUG").strip().upper()
+        self.log_format = os.getenv("LOG_FORMAT", "text").strip().lower()
+        self.log_max_bytes = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+        self.log_rotate_when = os.getenv("LOG_ROTATE_WHEN", "").strip()
+        self.log_backup_count = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+        self.log_compress = os.getenv("LOG_COMPRESS", "true").strip().lower() in ("1", "true", "yes")
+        # How chat message text appears in logs: "full", "truncate" (to LOG_BODY_MAX_CHARS) or "redact"
+        self.log_message_bodies = os.getenv("LOG_MESSAGE_BODIES", "full").strip().lower()
+        self.log_body_max_chars = int(os.getenv("LOG_BODY_MAX_CHARS", "200"))
         allowed_channels_env = os.getenv("ALLOWED_CHANNELS", "")
         self.allowed_channels = {
             ch.strip() for ch in allowed_channels_env.split(",") if ch.strip()
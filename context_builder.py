@@ -0,0 +1,150 @@
+import logging
+from collections import deque
+from memory_index import MemoryIndex
+
+logger = logging.getLogger(__name__)
+
+def estimate_tokens(text):
+    return (len(text) + 3) // 4
+
+class PreparedHistory:
+    def __init__(self, source, max_turns):
+        self.source = source
+        self.turns = deque(maxlen=max_turns)
+
+    def append(self, role, content, timestamp):
+        if content.strip():
+            role = "assistant" if role == "ai" else role
+            self.turns.append((role, content, estimate_tokens(content), timestamp))
+
+class ContextBuilder:
+    def __init__(self, memory_manager, config):
+        self.memory_manager = memory_manager
+        self.config = config
+        self.prepared = {}
+        self.indexes = {}
+        self.stats = {"builds": 0, "rebuilds": 0, "memory_searches": 0, "tokens_sent": 0, "tokens_saved": 0, "turns_dropped": 0, "turns_trimmed": 0}
+        memory_manager.add_listener(self.on_change)
+
+    def on_change(self, op, record):
+        if op in ("user_message", "ai_message"):
+            key = (record["guild_id"], record["user_id"], record["model"])
+            entry = self.prepared.get(key)
+            if entry is not None:
+                entry.append(op.split("_")[0], record["content"], record["timestamp"])
+        elif op == "reset_model_history":
+            self.prepared.pop((record["guild_id"], record["user_id"], record["model"]), None)
+        elif op == "wipe":
+            for key in [k for k in self.prepared if k[0] == record["guild_id"] and k[1] == record["user_id"]]:
+                del self.prepared[key]
+        elif op == "memory":
+            index = self.indexes.get(record["channel_id"])
+            if index is not None and index.source is self.memory_manager.channel_memories.get(record["channel_id"]):
+                index.add(record["memory"])
+                index.trim()
+
+    # Forget caches whose source history or memory list has been evicted or replaced
+    def prune(self):
+        memory_manager = self.memory_manager
+        self.prepared = {
+            key: entry for key, entry in self.prepared.items()
+            if memory_manager.user_model_histories.get(key[0], {}).get(key[1], {}).get(key[2]) is entry.source
+        }
+        self.indexes = {
+            channel_id: index for channel_id, index in self.indexes.items()
+            if memory_manager.channel_memories.get(channel_id) is index.source
+        }
+
+    def _history(self, guild_id, user_id, model):
+        key = (guild_id, user_id, model)
+        source = self.memory_manager.get_user_model_history(guild_id, user_id, model)
+        entry = self.prepared.get(key)
+        if entry is None or entry.source is not source:
+            entry = PreparedHistory(source, self.config.max_history)
+            for msg in source:
+                entry.append(msg.role, msg.content, msg.timestamp)
+            self.prepared[key] = entry
+            self.stats["rebuilds"] += 1
+        return entry
+
+    def _index(self, channel_id, source):
+        index = self.indexes.get(channel_id)
+        if index is None or index.source is not source:
+            index = MemoryIndex(source)
+            self.indexes[channel_id] = index
+        return index
+
+    # Small channels send every memory; larger ones send the top-k matches for the incoming message
+    # (topped up with the newest memories), most relevant first, within the memory token budget
+    def _memories(self, channel_id, query):
+        source = self.memory_manager.channel_memories.get(channel_id, [])
+        top_k = self.config.memory_top_k
+        if len(source) <= top_k:
+            picked = list(source)
+        else:
+            picked = self._index(channel_id, source).search(query or "", top_k)
+            self.stats["memory_searches"] += 1
+            chosen = set(picked)
+            for memory in reversed(source):
+                if len(picked) >= top_k:
+                    break
+                if memory not in chosen:
+                    picked.append(memory)
+        remaining = self.config.memory_token_budget
+        kept = []
+        for memory in picked:
+            tokens = estimate_tokens(memory)
+            if tokens <= remaining:
+                kept.append(memory)
+                remaining -= tokens
+        return kept
+
+    def build(self, channel_id, guild_id, user_id, model, query=None):
+        channel_id = str(channel_id)
+        guild_id = str(guild_id)
+        user_id = str(user_id)
+        budget = self.config.context_token_budget
+        system_prompt = f"{self.config.system_instructions}\nYou are {model}."
+        messages = [{"role": "system", "content": system_prompt}]
+        used = estimate_tokens(system_prompt)
+        channel_memories = self._memories(channel_id, query)
+        if channel_memories:
+            memory_text = "\n".join(channel_memories)
+            messages.append({"role": "user", "content": memory_text})
+            used += estimate_tokens(memory_text)
+        # Turns already folded into the summary are replaced by it
+        summary = self.memory_manager.get_summary(guild_id, user_id, model)
+        through = None
+        if summary:
+            summary_text = f"Summary of the earlier conversation:\n{summary['summary']}"
+            messages.append({"role": "system", "content": summary_text})
+            used += estimate_tokens(summary_text)
+            through = summary["through"]
+        history = self._history(guild_id, user_id, model)
+        remaining = max(budget - used, 0)
+        kept = []
+        full = 0
+        for role, content, tokens, timestamp in reversed(history.turns):
+            if through is not None and timestamp <= through:
+                break
+            full += tokens
+            if tokens <= remaining:
+                kept.append({"role": role, "content": content})
+                remaining -= tokens
+            elif not kept:
+                trimmed = content[:max(remaining, 1) * 4]
+                kept.append({"role": role, "content": trimmed})
+                remaining = 0
+                self.stats["turns_trimmed"] += 1
+            else:
+                self.stats["turns_dropped"] += 1
+                remaining = 0
+        sent = sum(estimate_tokens(m["content"]) for m in kept)
+        kept.reverse()
+        messages.extend(kept)
+        self.stats["builds"] += 1
+        self.stats["tokens_sent"] += used + sent
+        self.stats["tokens_saved"] += full - sent
+        if full > sent:
+            logger.info(f"Context for user {user_id} trimmed from {full} to {sent} history tokens (budget {budget})")
+        return messages
@@ -1,73 +1,380 @@
 import json
 import os
+import time
+import zlib
+import asyncio
 import logging
 import aiofiles
+from metrics import registry
 
 logger = logging.getLogger(__name__)
 
+SAVE_SECONDS = registry.histogram("unity_save_seconds", "Time spent persisting chat data", ["backend", "op"])
+SAVE_BYTES = registry.counter("unity_save_bytes_total", "Bytes written when persisting chat data", ["backend"])
+
 class DataManager:
-    def __init__(self, filename):
+    backend = "json"
+
+    def __init__(self, filename, flush_interval=0):
         self.filename = filename
+        self.flush_interval = flush_interval
         self.data = {"channels": {}, "user_models": {}, "user_histories": {}}
+        self.memory_manager = None
+        self.dirty = False
+        self.pending_changes = 0
+        # Channels/users evicted from MemoryManager, kept as compressed JSON until they are used again
+        self.cold = {}
+        self.stats = {"changes": 0, "save_requests": 0, "writes": 0, "coalesced": 0, "errors": 0}
+        self._flush_task = None
+        self._write_lock = None
         if not os.path.exists(filename):
             try:
-                with open(filename, "w") as f:
-                    json.dump(self.data, f, indent=4)
+                self._create_file()
                 logger.info(f"Created new data file at {filename}")
             except Exception as e:
                 logger.error(f"Failed to create data file {filename}: {e}")
                 raise
 
+    def _create_file(self):
+        with open(self.filename, "w") as f:
+            json.dump(self.data, f, indent=4)
+
+    def attach(self, memory_manager):
+        self.memory_manager = memory_manager
+        memory_manager.loader = self
+        if self.on_change not in memory_manager.listeners:
+            memory_manager.add_listener(self.on_change)
+
+    def on_change(self, op, record):
+        self.stats["changes"] += 1
+        self.mark_dirty()
+
+    def spill_channel(self, channel_id, memories, history):
+        self.cold[("channel", channel_id)] = zlib.compress(json.dumps({"memories": memories, "history": history}).encode("utf-8"))
+
+    def spill_user(self, guild_id, user_id, state):
+        self.cold[("user", guild_id, user_id)] = zlib.compress(json.dumps(state).encode("utf-8"))
+
+    def _thaw(self, key):
+        blob = self.cold.pop(key, None)
+        return {} if blob is None else json.loads(zlib.decompress(blob))
+
+    def load_channel(self, channel_id):
+        state = self._thaw(("channel", channel_id))
+        return state.get("memories", []), state.get("history", [])
+
+    def load_user(self, guild_id, user_id):
+        return self._thaw(("user", guild_id, user_id))
+
+    async def fetch_channel(self, channel_id):
+        return self.load_channel(channel_id)
+
+    async def fetch_user(self, guild_id, user_id):
+        return self.load_user(guild_id, user_id)
+
+    def mark_dirty(self):
+        self.dirty = True
+        self.pending_changes += 1
+
+    @property
+    def write_behind(self):
+        return self._flush_task is not None and not self._flush_task.done()
+
+    def start(self):
+        if self.flush_interval <= 0 or self.write_behind:
+            return
+        self._write_lock = asyncio.Lock()
+        self._flush_task = asyncio.create_task(self._flush_periodically())
+        logger.info(f"Write-behind persistence enabled (interval {self.flush_interval}s)")
+
+    async def close(self, memory_manager=None):
+        if self._flush_task:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush(memory_manager)
+        logger.info(f"Persistence stats: {self.stats}")
+
+    async def _flush_periodically(self):
+        while True:
+            try:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Error in write-behind flusher: {e}")
+
+    async def flush(self, memory_manager=None):
+        memory_manager = memory_manager or self.memory_manager
+        if not self.dirty or memory_manager is None:
+            return
+        if self._write_lock is None:
+            self._write_lock = asyncio.Lock()
+        async with self._write_lock:
+            if not self.dirty:
+                return
+            coalesced = max(self.pending_changes - 1, 0)
+            self.dirty = False
+            self.pending_changes = 0
+            if await self._write_async(memory_manager):
+                self.stats["coalesced"] += coalesced
+            else:
+                self.mark_dirty()
+
     def load_data(self, memory_manager):
         if os.path.exists(self.filename):
             try:
                 with open(self.filename, "r") as f:
                     self.data = json.loads(f.read())
-                for channel_id, channel_data in self.data.get("channels", {}).items():
-                    memory_manager.channel_memories[channel_id] = channel_data.get("memories", [])
-                    memory_manager.channel_histories[channel_id] = channel_data.get("history", [])
-                for guild_id, models in self.data.get("user_models", {}).items():
-                    memory_manager.user_models[guild_id] = models
-                for guild_id, histories in self.data.get("user_histories", {}).items():
-                    memory_manager.user_histories[guild_id] = histories
+                memory_manager.import_data(self.data)
+                usage = memory_manager.memory_usage()
+                logger.info(f"Loaded {usage['messages']} messages ({usage['bytes_per_message']:.0f} bytes/message)")
                 logger.info("Data loaded successfully from chat_data.json")
             except Exception as e:
                 logger.error(f"Error loading data from {self.filename}: {e}")
                 self.data = {"channels": {}, "user_models": {}, "user_histories": {}}
 
+    def _build_data(self, memory_manager):
+        data = memory_manager.export_data()
+        for key, blob in list(self.cold.items()):
+            state = json.loads(zlib.decompress(blob))
+            if key[0] == "channel":
+                data["channels"][key[1]] = state
+                continue
+            guild_id, user_id = key[1], key[2]
+            data["user_models"].setdefault(guild_id, {})[user_id] = state.get("model")
+            data["user_histories"].setdefault(guild_id, {})[user_id] = state.get("history", [])
+            data["user_model_histories"].setdefault(guild_id, {})[user_id] = state.get("model_histories", {})
+            if state.get("summaries"):
+                data["summaries"].setdefault(guild_id, {})[user_id] = state["summaries"]
+        return data
+
     async def save_data_async(self, memory_manager):
+        self.stats["save_requests"] += 1
+        if self.write_behind:
+            self.memory_manager = self.memory_manager or memory_manager
+            self.mark_dirty()
+            return
+        self.dirty = False
+        self.pending_changes = 0
+        with SAVE_SECONDS.time(backend=self.backend, op="save_request"):
+            await self._write_async(memory_manager)
+
+    async def _write_async(self, memory_manager):
+        tmp_filename = f"{self.filename}.tmp"
+        started = time.perf_counter()
         try:
-            data = {
-                "channels": {},
-                "user_models": memory_manager.user_models.copy(),
-                "user_histories": memory_manager.user_histories.copy()
-            }
-            for channel_id, mems in memory_manager.channel_memories.items():
-                data["channels"][channel_id] = {
-                    "memories": mems,
-                    "history": memory_manager.channel_histories.get(channel_id, [])
-                }
-
-            async with aiofiles.open(self.filename, "w") as f:
-                await f.write(json.dumps(data, indent=4))
+            payload = json.dumps(self._build_data(memory_manager), indent=4)
+            async with aiofiles.open(tmp_filename, "w") as f:
+                await f.write(payload)
+                await f.flush()
+            os.replace(tmp_filename, self.filename)
+            SAVE_SECONDS.observe(time.perf_counter() - started, backend=self.backend, op="snapshot")
+            SAVE_BYTES.inc(len(payload.encode("utf-8")), backend=self.backend)
+            self.stats["writes"] += 1
             logger.debug("Data saved successfully to chat_data.json")
+            return True
         except Exception as e:
+            self.stats["errors"] += 1
             logger.error(f"Error saving data to {self.filename}: {e}")
+            return False
 
     def save_data(self, memory_manager):
+        tmp_filename = f"{self.filename}.tmp"
+        started = time.perf_counter()
         try:
-            data = {
-                "channels": {},
-                "user_models": memory_manager.user_models.copy(),
-                "user_histories": memory_manager.user_histories.copy()
-            }
-            for channel_id, mems in memory_manager.channel_memories.items():
-                data["channels"][channel_id] = {
-                    "memories": mems,
-                    "history": memory_manager.channel_histories.get(channel_id, [])
-                }
-            with open(self.filename, "w") as f:
-                json.dump(data, f, indent=4)
+            with open(tmp_filename, "w") as f:
+                json.dump(self._build_data(memory_manager), f, indent=4)
+                size = f.tell()
+            os.replace(tmp_filename, self.filename)
+            SAVE_SECONDS.observe(time.perf_counter() - started, backend=self.backend, op="snapshot")
+            SAVE_BYTES.inc(size, backend=self.backend)
+            self.stats["writes"] += 1
+            self.dirty = False
+            self.pending_changes = 0
             logger.debug("Data saved successfully to chat_data.json")
+            return True
         except Exception as e:
-            logger.error(f"Error saving data to {self.filename}: {e}")
\ No newline at end of file
+            self.stats["errors"] += 1
+            logger.error(f"Error saving data to {self.filename}: {e}")
+            return False
+
+
+class JournalDataManager(DataManager):
+    backend = "journal"
+
+    def __init__(self, filename, max_journal_bytes=1024 * 1024):
+        super().__init__(filename)
+        self.journal_filename = f"{filename}.journal"
+        self.compacting_filename = f"{filename}.journal.compacting"
+        self.max_journal_bytes = max_journal_bytes
+        self.seq = 0
+        self.loaded = False
+        self.stats.update({"journal_records": 0, "journal_bytes": 0, "compactions": 0})
+        self._journal = None
+        self._compact_task = None
+
+    def load_data(self, memory_manager):
+        if self.loaded:
+            return
+        super().load_data(memory_manager)
+        self.seq = self.data.get("journal_seq", 0)
+        replayed = 0
+        for path in (self.compacting_filename, self.journal_filename):
+            if not os.path.exists(path):
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logger.warning(f"Skipping truncated journal record in {path}")
+                        continue
+                    seq = record.pop("seq", 0)
+                    if seq <= self.seq:
+                        continue
+                    memory_manager.apply(record.pop("op"), record)
+                    self.seq = seq
+                    replayed += 1
+        if os.path.exists(self.journal_filename):
+            self.stats["journal_bytes"] = os.path.getsize(self.journal_filename)
+        self.loaded = True
+        logger.info(f"Replayed {replayed} journal records on top of snapshot (seq {self.seq})")
+
+    def on_change(self, op, record):
+        self.stats["changes"] += 1
+        self.seq += 1
+        line = json.dumps({"seq": self.seq, "op": op, **record}, separators=(",", ":")) + "\n"
+        started = time.perf_counter()
+        try:
+            if self._journal is None:
+                self._journal = self._open_journal()
+            self._journal.write(line)
+            self._journal.flush()
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"Error appending to journal {self.journal_filename}: {e}")
+            return
+        size = len(line.encode("utf-8"))
+        SAVE_SECONDS.observe(time.perf_counter() - started, backend=self.backend, op="append")
+        SAVE_BYTES.inc(size, backend=self.backend)
+        self.stats["journal_records"] += 1
+        self.stats["journal_bytes"] += size
+        if self.stats["journal_bytes"] >= self.max_journal_bytes:
+            self._schedule_compaction()
+
+    def _open_journal(self):
+        needs_newline = False
+        if os.path.exists(self.journal_filename) and os.path.getsize(self.journal_filename) > 0:
+            with open(self.journal_filename, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b"\n"
+        journal = open(self.journal_filename, "a", encoding="utf-8")
+        if needs_newline:
+            journal.write("\n")
+        return journal
+
+    def _schedule_compaction(self):
+        if self._compact_task is not None and not self._compact_task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            if self.memory_manager is not None:
+                self.save_data(self.memory_manager)
+            return
+        self._compact_task = loop.create_task(self.compact())
+
+    def _rotate_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if not os.path.exists(self.journal_filename):
+            return
+        if os.path.exists(self.compacting_filename):
+            with open(self.journal_filename, "r", encoding="utf-8") as src, open(self.compacting_filename, "a", encoding="utf-8") as dst:
+                dst.write(src.read())
+            os.remove(self.journal_filename)
+        else:
+            os.replace(self.journal_filename, self.compacting_filename)
+        self.stats["journal_bytes"] = 0
+
+    async def compact(self):
+        if self.memory_manager is None:
+            return
+        self._rotate_journal()
+        if await self._write_async(self.memory_manager):
+            if os.path.exists(self.compacting_filename):
+                os.remove(self.compacting_filename)
+            self.stats["compactions"] += 1
+            logger.info(f"Compacted journal into snapshot at seq {self.seq}")
+
+    def _build_data(self, memory_manager):
+        data = super()._build_data(memory_manager)
+        data["journal_seq"] = self.seq
+        return data
+
+    def start(self):
+        pass
+
+    async def save_data_async(self, memory_manager):
+        self.stats["save_requests"] += 1
+
+    def save_data(self, memory_manager):
+        self._rotate_journal()
+        saved = super().save_data(memory_manager)
+        if saved and os.path.exists(self.compacting_filename):
+            os.remove(self.compacting_filename)
+        return saved
+
+    async def flush(self, memory_manager=None):
+        if self._journal is not None:
+            self._journal.flush()
+
+    async def close(self, memory_manager=None):
+        if self._compact_task is not None:
+            await self._compact_task
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        logger.info(f"Persistence stats: {self.stats}")
+
+
+def create_data_manager(config, filename):
+    shared = config.shard_ids is not None
+    if shared and config.storage_backend != "sqlite":
+        logger.warning(f"STORAGE_BACKEND={config.storage_backend} cannot be shared between shard processes; using sqlite")
+    if config.storage_backend == "sqlite" or shared:
+        from sqlite_store import SQLiteDataManager
+        return SQLiteDataManager(
+            f"{os.path.splitext(filename)[0]}.db",
+            json_filename=filename,
+            flush_interval=config.save_interval,
+            max_history=config.max_history,
+            max_memories=config.max_memories,
+            sync_interval=config.state_sync_interval if shared else 0,
+            origin=f"shards-{','.join(map(str, config.shard_ids))}" if shared else None,
+        )
+    if config.storage_backend == "snapshot":
+        from snapshot_store import SnapshotDataManager
+        return SnapshotDataManager(
+            f"{os.path.splitext(filename)[0]}.snap",
+            json_filename=filename,
+            flush_interval=config.save_interval,
+            compress=config.snapshot_compress,
+        )
+    if config.storage_backend == "partitioned":
+        from partition_store import PartitionedDataManager
+        return PartitionedDataManager(
+            os.path.splitext(filename)[0],
+            json_filename=filename,
+            flush_interval=config.save_interval,
+            compress=config.snapshot_compress,
+        )
+    if config.storage_backend == "journal":
+        return JournalDataManager(filename, max_journal_bytes=config.journal_max_bytes)
+    return DataManager(filename, flush_interval=config.save_interval)
@@ -0,0 +1,78 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Collects messages from the same user in the same channel until they have been quiet for `window`
+# seconds, then hands them to `submit` as one batch (oldest first) so they get a single reply.
+# A newer message supersedes the batch before it: a completion still in flight for that user is
+# cancelled, and one not yet started is skipped, since the next batch answers everything.
+class MessageDebouncer:
+    def __init__(self, window, submit):
+        self.window = window
+        self.submit = submit
+        self.pending = {}
+        self.timers = {}
+        self.latest = {}
+        self.inflight = {}
+        self.stats = {"messages": 0, "batches": 0, "merged": 0, "cancelled": 0, "superseded": 0}
+
+    @staticmethod
+    def key(message):
+        return (str(message.channel.id), str(message.author.id))
+
+    def add(self, message):
+        key = self.key(message)
+        self.stats["messages"] += 1
+        self.latest[key] = message
+        self.pending.setdefault(key, []).append(message)
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        task = self.inflight.get(key)
+        if task is not None and not task.done():
+            task.cancel()
+            self.stats["cancelled"] += 1
+        self.timers[key] = asyncio.get_running_loop().call_later(self.window, self._flush, key)
+
+    def _flush(self, key):
+        self.timers.pop(key, None)
+        messages = self.pending.pop(key, None)
+        if messages:
+            self.stats["batches"] += 1
+            self.stats["merged"] += len(messages) - 1
+            self.submit(messages)
+
+    def superseded(self, message):
+        latest = self.latest.get(self.key(message))
+        return latest is not None and latest is not message
+
+    async def run(self, message, coro):
+        key = self.key(message)
+        task = asyncio.ensure_future(coro)
+        self.inflight[key] = task
+        try:
+            # wait() rather than await so a cancel from add() only hits the completion, not the caller
+            await asyncio.wait({task})
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            if self.inflight.get(key) is task:
+                del self.inflight[key]
+        if task.cancelled():
+            self.stats["superseded"] += 1
+            return None
+        return task.result()
+
+    def done(self, message):
+        key = self.key(message)
+        if self.latest.get(key) is message:
+            del self.latest[key]
+
+    def close(self):
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers.clear()
+        self.pending.clear()
+        logger.info(f"Debouncer stats: {self.stats}")
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+from collections import OrderedDict
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+]
+
+CONTENT_TYPES = {
+    "image/png": "png",
+    "image/jpeg": "jpg",
+    "image/jpg": "jpg",
+    "image/gif": "gif",
+    "image/webp": "webp",
+}
+
+def sniff_extension(data, content_type=""):
+    for signature, ext in SIGNATURES:
+        if data.startswith(signature):
+            return ext
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return CONTENT_TYPES.get(content_type.split(";")[0].strip().lower())
+
+class ImageFetcher:
+    def __init__(self, max_bytes=8 * 1024 * 1024, timeout=15, concurrency=4, cache_max_bytes=32 * 1024 * 1024, cache_max_entries=64):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.cache_max_bytes = cache_max_bytes
+        self.cache_max_entries = cache_max_entries
+        self.session: aiohttp.ClientSession | None = None
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        self.stats = {"fetched": 0, "cache_hits": 0, "too_large": 0, "not_image": 0, "failed": 0, "timed_out": 0, "bytes": 0}
+
+    async def _session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.concurrency, ttl_dns_cache=300)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def close(self):
+        if self.session and not self.session.closed:
+            await self.session.close()
+            self.session = None
+
+    def _cache_get(self, url):
+        entry = self.cache.get(url)
+        if entry is not None:
+            self.cache.move_to_end(url)
+            self.stats["cache_hits"] += 1
+        return entry
+
+    def _cache_put(self, url, data, ext):
+        if len(data) > self.cache_max_bytes:
+            return
+        old = self.cache.pop(url, None)
+        if old is not None:
+            self.cache_bytes -= len(old[0])
+        self.cache[url] = (data, ext)
+        self.cache_bytes += len(data)
+        while self.cache and (self.cache_bytes > self.cache_max_bytes or len(self.cache) > self.cache_max_entries):
+            _, (evicted, _) = self.cache.popitem(last=False)
+            self.cache_bytes -= len(evicted)
+
+    async def fetch(self, url):
+        cached = self._cache_get(url)
+        if cached is not None:
+            return cached
+        session = await self._session()
+        try:
+            async with session.get(url) as resp:
+                if resp.status != 200:
+                    self.stats["failed"] += 1
+                    logger.error(f"Failed to fetch image from {url}: status {resp.status}")
+                    return None
+                if resp.content_length and resp.content_length > self.max_bytes:
+                    self.stats["too_large"] += 1
+                    logger.warning(f"Image at {url} is {resp.content_length} bytes, over the {self.max_bytes} byte limit")
+                    return None
+                # Read to EOF (content.read(n) only returns what is already buffered), giving up past the limit
+                body = bytearray()
+                async for chunk in resp.content.iter_chunked(64 * 1024):
+                    body += chunk
+                    if len(body) > self.max_bytes:
+                        self.stats["too_large"] += 1
+                        logger.warning(f"Image at {url} exceeds the {self.max_bytes} byte limit")
+                        return None
+                data = bytes(body)
+                if resp.content_length is not None and "Content-Encoding" not in resp.headers and len(data) != resp.content_length:
+                    self.stats["failed"] += 1
+                    logger.error(f"Image at {url} ended after {len(data)} of {resp.content_length} bytes")
+                    return None
+                ext = sniff_extension(data, resp.headers.get("Content-Type", ""))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.stats["failed"] += 1
+            logger.error(f"Error fetching image from {url}: {e}")
+            return None
+        if ext is None:
+            self.stats["not_image"] += 1
+            logger.warning(f"Skipping {url}: response is not a recognised image")
+            return None
+        self.stats["fetched"] += 1
+        self.stats["bytes"] += len(data)
+        self._cache_put(url, data, ext)
+        return data, ext
+
+    async def fetch_all(self, urls):
+        if not urls:
+            return []
+        tasks = [asyncio.ensure_future(self.fetch(url)) for url in urls]
+        done, pending = await asyncio.wait(tasks, timeout=self.timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            self.stats["timed_out"] += len(pending)
+            logger.warning(f"Gave up on {len(pending)} of {len(urls)} images after {self.timeout}s")
+            await asyncio.gather(*pending, return_exceptions=True)
+        return [task.result() for task in tasks if task in done and task.result() is not None]
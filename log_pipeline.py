@@ -0,0 +1,103 @@
+import os
+import gzip
+import json
+import queue
+import shutil
+import atexit
+import logging
+import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+def _gzip_namer(name):
+    return f"{name}.gz"
+
+def _gzip_rotator(source, dest):
+    with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+class BodyFilter(logging.Filter):
+    # Records may carry user-written text in `extra={"body": ...}`; this decides how much of it is kept
+    def __init__(self, mode="full", max_chars=200):
+        super().__init__()
+        self.mode = mode
+        self.max_chars = max_chars
+
+    def filter(self, record):
+        body = getattr(record, "body", None)
+        if body is None or getattr(record, "body_filtered", False):
+            return True
+        record.body_filtered = True
+        body = str(body)
+        if self.mode == "redact":
+            record.body = f"<redacted {len(body)} chars>"
+        elif self.mode == "truncate" and len(body) > self.max_chars:
+            record.body = f"{body[:self.max_chars]}… <{len(body) - self.max_chars} more chars>"
+        else:
+            record.body = body
+        return True
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        text = super().format(record)
+        body = getattr(record, "body", None)
+        return text if body is None else f"{text}: {body}"
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        body = getattr(record, "body", None)
+        if body is not None:
+            entry["body"] = body
+        return json.dumps(entry, ensure_ascii=False)
+
+# All records go through a queue and are written by a listener thread, so the event loop never waits on disk.
+# Records logged before configure() is first called stay queued until the listener starts.
+class LogPipeline:
+    def __init__(self, filename, level=logging.DEBUG):
+        self.filename = filename
+        self.queue = queue.SimpleQueue()
+        self.listener = None
+        self.console = None
+        root = logging.getLogger("")
+        root.setLevel(level)
+        root.addHandler(QueueHandler(self.queue))
+        atexit.register(self.stop)
+
+    def configure(self, filename=None, fmt="text", level=logging.DEBUG, console_level=logging.INFO, max_bytes=10 * 1024 * 1024,
+                  when="", backup_count=5, compress=True, bodies="full", body_max_chars=200):
+        self.stop()
+        if filename:
+            self.filename = filename
+        if when:
+            file_handler = TimedRotatingFileHandler(self.filename, when=when, backupCount=backup_count, encoding="utf-8")
+        else:
+            file_handler = RotatingFileHandler(self.filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        if compress:
+            file_handler.namer = _gzip_namer
+            file_handler.rotator = _gzip_rotator
+        file_handler.setLevel(level)
+        file_handler.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter(TEXT_FORMAT))
+        self.console = logging.StreamHandler()
+        self.console.setLevel(console_level)
+        self.console.setFormatter(TextFormatter(TEXT_FORMAT))
+        body_filter = BodyFilter(bodies, body_max_chars)
+        for handler in (file_handler, self.console):
+            handler.addFilter(body_filter)
+        self.listener = QueueListener(self.queue, file_handler, self.console, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        if self.listener is None:
+            return
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
+        self.listener = None
@@ -0,0 +1,73 @@
+import re
+import math
+import heapq
+
+WORD = re.compile(r"\w+")
+STOPWORDS = frozenset(
+    "a an and are as at be but by do for from has have he her his i if in is it its me my no not of on or our "
+    "she so that the their them they this to was we were what when who will with you your".split()
+)
+
+def tokenize(text):
+    return [word for word in WORD.findall(text.lower()) if word not in STOPWORDS]
+
+# Inverted index over one channel's memories, scored with BM25. Memories are unique per channel,
+# so the text itself is the document key; docs keeps insertion order so the oldest can be dropped first.
+class MemoryIndex:
+    def __init__(self, source, k1=1.2, b=0.75):
+        self.source = source
+        self.k1 = k1
+        self.b = b
+        self.docs = {}
+        self.postings = {}
+        self.total_length = 0
+        for memory in source:
+            self.add(memory)
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, memory):
+        if memory in self.docs:
+            return
+        counts = {}
+        for word in tokenize(memory):
+            counts[word] = counts.get(word, 0) + 1
+        length = sum(counts.values())
+        self.docs[memory] = length
+        self.total_length += length
+        for word, count in counts.items():
+            self.postings.setdefault(word, {})[memory] = count
+
+    def remove(self, memory):
+        length = self.docs.pop(memory, None)
+        if length is None:
+            return
+        self.total_length -= length
+        for word in set(tokenize(memory)):
+            docs = self.postings.get(word)
+            if docs is not None:
+                docs.pop(memory, None)
+                if not docs:
+                    del self.postings[word]
+
+    # Drop the oldest entries once the source list has been trimmed
+    def trim(self):
+        while len(self.docs) > len(self.source):
+            self.remove(next(iter(self.docs)))
+
+    def search(self, query, k):
+        count = len(self.docs)
+        if not count:
+            return []
+        average = self.total_length / count or 1
+        scores = {}
+        for word in set(tokenize(query)):
+            docs = self.postings.get(word)
+            if not docs:
+                continue
+            idf = math.log(1 + (count - len(docs) + 0.5) / (len(docs) + 0.5))
+            for memory, tf in docs.items():
+                norm = self.k1 * (1 - self.b + self.b * self.docs[memory] / average)
+                scores[memory] = scores.get(memory, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        return heapq.nlargest(k, scores, key=scores.get)
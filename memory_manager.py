@@ -1,42 +1,309 @@
+import sys
+import time
 import datetime
 import logging
+from collections import deque, OrderedDict
+from metrics import registry
 
 logger = logging.getLogger(__name__)
 
+class Message:
+    __slots__ = ("role", "content", "user_id", "timestamp", "status")
+
+    def __init__(self, role, content, user_id=None, timestamp=None, status="active"):
+        self.role = role
+        self.content = content
+        self.user_id = user_id
+        self.timestamp = self.parse_timestamp(timestamp)
+        self.status = status
+
+    @staticmethod
+    def parse_timestamp(value):
+        if value is None:
+            return time.time()
+        if isinstance(value, (int, float)):
+            return float(value)
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        try:
+            return datetime.datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            return 0.0
+
+    @classmethod
+    def from_dict(cls, data, user_id=None):
+        return cls(data["role"], data["content"], data.get("user_id", user_id), data.get("timestamp"), data.get("status", "active"))
+
+    def to_dict(self):
+        return {
+            "role": self.role,
+            "content": self.content,
+            "user_id": self.user_id,
+            "timestamp": str(datetime.datetime.fromtimestamp(self.timestamp)),
+            "status": self.status
+        }
+
+    def key(self):
+        return (self.user_id, self.role, self.timestamp, self.content)
+
+USERS_HELD = registry.gauge("unity_memory_users", "Users with chat state held in memory")
+CHANNELS_HELD = registry.gauge("unity_memory_channels", "Channels with chat state held in memory")
+MESSAGES_HELD = registry.gauge("unity_memory_messages", "Distinct chat messages held in memory")
+EVICTED_HELD = registry.gauge("unity_memory_evicted", "Channels/users evicted from memory and not yet reloaded", ["kind"])
+EVICTIONS = registry.counter("unity_memory_evictions_total", "Channels/users dropped from memory", ["kind"])
+RELOADS = registry.counter("unity_memory_reloads_total", "Evicted channels/users loaded back on access", ["kind"])
+
 class MemoryManager:
-    def __init__(self):
+    def __init__(self, max_history=20, max_memories=5):
+        self.max_history = max_history
+        self.max_memories = max_memories
         self.channel_memories = {}
         self.channel_histories = {}
         self.user_histories = {}
         self.user_models = {}
         self.user_model_histories = {}
+        # guild -> user -> model -> {"summary": text, "through": timestamp of the last summarized turn}
+        self.summaries = {}
         self.models = []
+        self.model_index = {}
         self.api_client = None
+        self.listeners = []
+        self.loader = None
+        self._replaying = False
+        # ("channel", id) / ("user", guild, user) -> last access, least recently used first
+        self.access = OrderedDict()
+        self.evicted = set()
+        # Entries (keys as in access) changed since the last take_dirty(), for loaders that save per partition
+        self.track_dirty = False
+        self.dirty = set()
+        USERS_HELD.set_function(lambda: sum(len(users) for users in self.user_histories.values()))
+        CHANNELS_HELD.set_function(lambda: len(self.channel_histories))
+        MESSAGES_HELD.set_function(lambda: len({id(msg) for history in self._all_histories() for msg in history}))
+        EVICTED_HELD.set_function(self._evicted_counts)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def _notify(self, op, **record):
+        if self._replaying:
+            return
+        if self.track_dirty:
+            if "channel_id" in record:
+                self.dirty.add(("channel", record["channel_id"]))
+            if "user_id" in record:
+                self.dirty.add(("user", record["guild_id"], record["user_id"]))
+        for listener in self.listeners:
+            try:
+                listener(op, record)
+            except Exception as e:
+                logger.error(f"Memory listener failed for {op}: {e}")
+
+    def apply(self, op, record):
+        self._replaying = True
+        try:
+            if op in ("user_message", "ai_message"):
+                self._append_message(op.split("_")[0], record["channel_id"], record["guild_id"], record["user_id"], record["content"], record["model"], record["timestamp"])
+            elif op == "memory":
+                self.add_memory(record["channel_id"], record["memory"])
+            elif op == "user_model":
+                self.initialize_user(record["guild_id"], record["user_id"])
+                self.user_models[record["guild_id"]][record["user_id"]] = record["model"]
+            elif op == "reset_model_history":
+                self.reset_user_model_history(record["guild_id"], record["user_id"], record["model"])
+            elif op == "summary":
+                self.set_summary(record["guild_id"], record["user_id"], record["model"], record["summary"], record["through"])
+            elif op == "wipe":
+                self.wipe_user(record["channel_id"], record["guild_id"], record["user_id"])
+            else:
+                logger.warning(f"Skipping unknown memory record {op}")
+        finally:
+            self._replaying = False
+
+    def take_dirty(self):
+        dirty, self.dirty = self.dirty, set()
+        return dirty
 
     def set_models(self, models):
         self.models = models
+        self.model_index = {m["name"].lower(): m["name"] for m in models}
         logger.info(f"Set {len(models)} models")
 
+    # Loads through the loader's async fetch_* so the event loop never waits on storage; the synchronous
+    # load_* in initialize_* is only a fallback for entries dropped again before use
+    async def preload(self, channel_id, guild_id, user_id):
+        await self.preload_channel(channel_id)
+        await self.preload_user(guild_id, user_id)
+
+    async def preload_channel(self, channel_id):
+        if self.loader is None:
+            return
+        channel_id = str(channel_id)
+        if channel_id not in self.channel_histories:
+            memories, history = await self.loader.fetch_channel(channel_id)
+            if channel_id not in self.channel_histories:
+                self.set_channel_state(channel_id, memories, history)
+
+    async def preload_user(self, guild_id, user_id):
+        if self.loader is None:
+            return
+        guild_id = str(guild_id)
+        user_id = str(user_id)
+        if user_id not in self.user_histories.get(guild_id, {}):
+            state = await self.loader.fetch_user(guild_id, user_id)
+            if user_id not in self.user_histories.get(guild_id, {}):
+                self.set_user_state(guild_id, user_id, state)
+
+    def _history(self, messages=(), user_id=None, interned=None):
+        history = deque(maxlen=self.max_history)
+        for data in messages:
+            msg = Message.from_dict(data, user_id)
+            if interned is not None:
+                msg = interned.setdefault(msg.key(), msg)
+            history.append(msg)
+        return history
+
+    def _touch(self, key):
+        self.access[key] = time.monotonic()
+        self.access.move_to_end(key)
+
+    def _reloaded(self, key):
+        if key in self.evicted:
+            self.evicted.discard(key)
+            RELOADS.inc(kind=key[0])
+
+    def _evicted_counts(self):
+        counts = {("channel",): 0, ("user",): 0}
+        for key in self.evicted:
+            counts[(key[0],)] += 1
+        return counts
+
+    def set_channel_state(self, channel_id, memories, history, interned=None):
+        self._reloaded(("channel", channel_id))
+        self._touch(("channel", channel_id))
+        self.channel_memories[channel_id] = list(memories)[-self.max_memories:]
+        self.channel_histories[channel_id] = self._history(history, interned=interned)
+
+    def set_user_state(self, guild_id, user_id, state, interned=None):
+        if interned is None:
+            interned = {}
+        self._reloaded(("user", guild_id, user_id))
+        self._touch(("user", guild_id, user_id))
+        self.user_histories.setdefault(guild_id, {})[user_id] = self._history(state.get("history", []), user_id, interned)
+        self.user_models.setdefault(guild_id, {})[user_id] = state.get("model")
+        self.user_model_histories.setdefault(guild_id, {})[user_id] = {
+            model: self._history(history, user_id, interned)
+            for model, history in state.get("model_histories", {}).items()
+        }
+        self.summaries.setdefault(guild_id, {})[user_id] = dict(state.get("summaries", {}))
+
+    def import_data(self, data):
+        interned = {}
+        for channel_id, channel_data in data.get("channels", {}).items():
+            self.set_channel_state(channel_id, channel_data.get("memories", []), channel_data.get("history", []), interned)
+        user_models = data.get("user_models", {})
+        user_histories = data.get("user_histories", {})
+        user_model_histories = data.get("user_model_histories", {})
+        summaries = data.get("summaries", {})
+        for guild_id in set(user_models) | set(user_histories) | set(user_model_histories) | set(summaries):
+            users = set(user_models.get(guild_id, {})) | set(user_histories.get(guild_id, {})) | set(user_model_histories.get(guild_id, {})) | set(summaries.get(guild_id, {}))
+            for user_id in users:
+                self.set_user_state(guild_id, user_id, {
+                    "model": user_models.get(guild_id, {}).get(user_id),
+                    "history": user_histories.get(guild_id, {}).get(user_id, []),
+                    "model_histories": user_model_histories.get(guild_id, {}).get(user_id, {}),
+                    "summaries": summaries.get(guild_id, {}).get(user_id, {}),
+                }, interned)
+
+    def export_data(self):
+        return {
+            "channels": {
+                channel_id: {
+                    "memories": list(memories),
+                    "history": [msg.to_dict() for msg in self.channel_histories.get(channel_id, ())]
+                }
+                for channel_id, memories in self.channel_memories.items()
+            },
+            "user_models": {guild_id: dict(users) for guild_id, users in self.user_models.items()},
+            "user_histories": {
+                guild_id: {user_id: [msg.to_dict() for msg in history] for user_id, history in users.items()}
+                for guild_id, users in self.user_histories.items()
+            },
+            "user_model_histories": {
+                guild_id: {
+                    user_id: {model: [msg.to_dict() for msg in history] for model, history in models.items()}
+                    for user_id, models in users.items()
+                }
+                for guild_id, users in self.user_model_histories.items()
+            },
+            "summaries": {
+                guild_id: {user_id: dict(models) for user_id, models in users.items() if models}
+                for guild_id, users in self.summaries.items()
+            }
+        }
+
+    def _all_histories(self):
+        yield from self.channel_histories.values()
+        for users in self.user_histories.values():
+            yield from users.values()
+        for users in self.user_model_histories.values():
+            for models in users.values():
+                yield from models.values()
+
+    def memory_usage(self):
+        seen = set()
+        total = 0
+        views = 0
+        for history in self._all_histories():
+            total += sys.getsizeof(history)
+            for msg in history:
+                views += 1
+                if id(msg) not in seen:
+                    seen.add(id(msg))
+                    total += sys.getsizeof(msg) + sys.getsizeof(msg.content)
+        messages = len(seen)
+        return {
+            "messages": messages,
+            "views": views,
+            "bytes": total,
+            "bytes_per_message": total / messages if messages else 0.0
+        }
+
     def initialize_channel(self, channel_id):
         channel_id = str(channel_id)
+        if self.loader is not None and channel_id not in self.channel_histories:
+            memories, history = self.loader.load_channel(channel_id)
+            self.set_channel_state(channel_id, memories, history)
         self.channel_memories.setdefault(channel_id, [])
-        self.channel_histories.setdefault(channel_id, [])
+        if channel_id not in self.channel_histories:
+            self.channel_histories[channel_id] = deque(maxlen=self.max_history)
+        self._touch(("channel", channel_id))
 
     def initialize_user(self, guild_id, user_id):
         guild_id = str(guild_id)
         user_id = str(user_id)
-        self.user_histories.setdefault(guild_id, {}).setdefault(user_id, [])
+        if self.loader is not None and user_id not in self.user_histories.get(guild_id, {}):
+            self.set_user_state(guild_id, user_id, self.loader.load_user(guild_id, user_id))
+        users = self.user_histories.setdefault(guild_id, {})
+        if user_id not in users:
+            users[user_id] = deque(maxlen=self.max_history)
         self.user_models.setdefault(guild_id, {}).setdefault(user_id, None)
         self.user_model_histories.setdefault(guild_id, {}).setdefault(user_id, {})
+        self.summaries.setdefault(guild_id, {}).setdefault(user_id, {})
+        self._touch(("user", guild_id, user_id))
 
     def add_memory(self, channel_id, memory):
         channel_id = str(channel_id)
         self.initialize_channel(channel_id)
         memory = memory.strip()
-        if memory and memory not in self.channel_memories[channel_id]:
-            self.channel_memories[channel_id].append(memory)
-            if len(self.channel_memories[channel_id]) > 5:
-                self.channel_memories[channel_id] = self.channel_memories[channel_id][-5:]
+        memories = self.channel_memories[channel_id]
+        if memory and memory not in memories:
+            # Trim in place so the context builder's search index stays attached to this list
+            memories.append(memory)
+            if len(memories) > self.max_memories:
+                del memories[:-self.max_memories]
+            self._notify("memory", channel_id=channel_id, memory=memory)
 
     def get_memories(self, channel_id):
         channel_id = str(channel_id)
@@ -47,76 +314,31 @@ class MemoryManager:
         guild_id = str(guild_id)
         user_id = str(user_id)
         model_name = str(model_name)
-        self.user_model_histories.setdefault(guild_id, {}).setdefault(user_id, {}).setdefault(model_name, [])
-        return self.user_model_histories[guild_id][user_id][model_name]
+        self.initialize_user(guild_id, user_id)
+        models = self.user_model_histories[guild_id][user_id]
+        if model_name not in models:
+            models[model_name] = deque(maxlen=self.max_history)
+        return models[model_name]
 
     def add_user_message(self, channel_id, guild_id, user_id, message_content):
-        channel_id = str(channel_id)
-        guild_id = str(guild_id)
-        user_id = str(user_id)
-        self.initialize_channel(channel_id)
-        self.initialize_user(guild_id, user_id)
-        model = self.get_user_model(guild_id, user_id)
-        user_model_history = self.get_user_model_history(guild_id, user_id, model)
-        user_model_history.append({
-            "role": "user",
-            "content": message_content,
-            "timestamp": str(datetime.datetime.now()),
-            "status": "active"
-        })
-        if len(user_model_history) > 20:
-            user_model_history[:] = user_model_history[-20:]
-        self.channel_histories[channel_id].append({
-            "role": "user",
-            "content": message_content,
-            "user_id": user_id,
-            "timestamp": str(datetime.datetime.now()),
-            "status": "active"
-        })
-        if len(self.channel_histories[channel_id]) > 20:
-            self.channel_histories[channel_id] = self.channel_histories[channel_id][-20:]
-        self.user_histories[guild_id][user_id].append({
-            "role": "user",
-            "content": message_content,
-            "timestamp": str(datetime.datetime.now()),
-            "status": "active"
-        })
-        if len(self.user_histories[guild_id][user_id]) > 20:
-            self.user_histories[guild_id][user_id] = self.user_histories[guild_id][user_id][-20:]
+        self._append_message("user", channel_id, guild_id, user_id, message_content)
 
     def add_ai_message(self, channel_id, guild_id, user_id, message_content):
+        self._append_message("ai", channel_id, guild_id, user_id, message_content)
+
+    def _append_message(self, role, channel_id, guild_id, user_id, message_content, model=None, timestamp=None):
         channel_id = str(channel_id)
         guild_id = str(guild_id)
         user_id = str(user_id)
         self.initialize_channel(channel_id)
         self.initialize_user(guild_id, user_id)
-        model = self.get_user_model(guild_id, user_id)
-        user_model_history = self.get_user_model_history(guild_id, user_id, model)
-        user_model_history.append({
-            "role": "ai",
-            "content": message_content,
-            "timestamp": str(datetime.datetime.now()),
-            "status": "active"
-        })
-        if len(user_model_history) > 20:
-            user_model_history[:] = user_model_history[-20:]
-        self.channel_histories[channel_id].append({
-            "role": "ai",
-            "content": message_content,
-            "user_id": user_id,
-            "timestamp": str(datetime.datetime.now()),
-            "status": "active"
-        })
-        if len(self.channel_histories[channel_id]) > 20:
-            self.channel_histories[channel_id] = self.channel_histories[channel_id][-20:]
-        self.user_histories[guild_id][user_id].append({
-            "role": "ai",
-            "content": message_content,
-            "timestamp": str(datetime.datetime.now()),
-            "status": "active"
-        })
-        if len(self.user_histories[guild_id][user_id]) > 20:
-            self.user_histories[guild_id][user_id] = self.user_histories[guild_id][user_id][-20:]
+        if model is None:
+            model = self.get_user_model(guild_id, user_id)
+        msg = Message(role, message_content, user_id, timestamp)
+        self.get_user_model_history(guild_id, user_id, model).append(msg)
+        self.channel_histories[channel_id].append(msg)
+        self.user_histories[guild_id][user_id].append(msg)
+        self._notify(f"{role}_message", channel_id=channel_id, guild_id=guild_id, user_id=user_id, model=model, content=message_content, timestamp=msg.timestamp)
 
     def get_user_history(self, guild_id, user_id):
         guild_id = str(guild_id)
@@ -127,21 +349,137 @@ class MemoryManager:
     def get_channel_history(self, channel_id):
         channel_id = str(channel_id)
         self.initialize_channel(channel_id)
-        return [msg for msg in self.channel_histories[channel_id] if msg["status"] == "active"]
+        return [msg for msg in self.channel_histories[channel_id] if msg.status == "active"]
 
     def set_user_model(self, guild_id, user_id, model_name):
         guild_id = str(guild_id)
         user_id = str(user_id)
         self.initialize_user(guild_id, user_id)
-        model_name_lower = model_name.lower()
-        for m in self.models:
-            if m["name"].lower() == model_name_lower:
-                self.user_models[guild_id][user_id] = m["name"]
-                logger.info(f"Set model for user {user_id} in guild {guild_id} to {m['name']}")
-                return True
+        name = self.model_index.get(model_name.lower())
+        if name is not None:
+            self.user_models[guild_id][user_id] = name
+            self._notify("user_model", guild_id=guild_id, user_id=user_id, model=name)
+            logger.info(f"Set model for user {user_id} in guild {guild_id} to {name}")
+            return True
         logger.warning(f"Model {model_name} not found for user {user_id} in guild {guild_id}")
         return False
 
+    def reset_user_model_history(self, guild_id, user_id, model_name):
+        guild_id = str(guild_id)
+        user_id = str(user_id)
+        model_name = str(model_name)
+        self.get_user_model_history(guild_id, user_id, model_name).clear()
+        self.summaries[guild_id][user_id].pop(model_name, None)
+        self._notify("reset_model_history", guild_id=guild_id, user_id=user_id, model=model_name)
+
+    def wipe_user(self, channel_id, guild_id, user_id):
+        channel_id = str(channel_id)
+        guild_id = str(guild_id)
+        user_id = str(user_id)
+        self.initialize_channel(channel_id)
+        self.initialize_user(guild_id, user_id)
+        self.channel_histories[channel_id].clear()
+        self.user_histories[guild_id][user_id].clear()
+        for history in self.user_model_histories[guild_id][user_id].values():
+            history.clear()
+        self.summaries[guild_id][user_id].clear()
+        self._notify("wipe", channel_id=channel_id, guild_id=guild_id, user_id=user_id)
+
+    # Drop cached state so the loader re-reads it on next access; only meaningful when a loader is attached.
+    # Loaders that do not persist every change themselves get the state handed over through spill_*.
+    def evict_channel(self, channel_id):
+        channel_id = str(channel_id)
+        if channel_id in self.channel_histories:
+            spill = getattr(self.loader, "spill_channel", None)
+            if spill is not None:
+                spill(channel_id, list(self.channel_memories.get(channel_id, [])), [msg.to_dict() for msg in self.channel_histories[channel_id]])
+            self.evicted.add(("channel", channel_id))
+            EVICTIONS.inc(kind="channel")
+        self.channel_histories.pop(channel_id, None)
+        self.channel_memories.pop(channel_id, None)
+        self.access.pop(("channel", channel_id), None)
+
+    def evict_user(self, guild_id, user_id):
+        guild_id = str(guild_id)
+        user_id = str(user_id)
+        if user_id in self.user_histories.get(guild_id, {}):
+            spill = getattr(self.loader, "spill_user", None)
+            if spill is not None:
+                spill(guild_id, user_id, self._user_state(guild_id, user_id))
+            self.evicted.add(("user", guild_id, user_id))
+            EVICTIONS.inc(kind="user")
+        for users in (self.user_histories, self.user_models, self.user_model_histories, self.summaries):
+            if guild_id in users:
+                users[guild_id].pop(user_id, None)
+                if not users[guild_id]:
+                    del users[guild_id]
+        self.access.pop(("user", guild_id, user_id), None)
+
+    def _user_state(self, guild_id, user_id):
+        return {
+            "model": self.user_models.get(guild_id, {}).get(user_id),
+            "history": [msg.to_dict() for msg in self.user_histories.get(guild_id, {}).get(user_id, ())],
+            "model_histories": {
+                model: [msg.to_dict() for msg in history]
+                for model, history in self.user_model_histories.get(guild_id, {}).get(user_id, {}).items()
+            },
+            "summaries": dict(self.summaries.get(guild_id, {}).get(user_id, {})),
+        }
+
+    # Serializable state of one loaded channel/user, or None if it is not in memory
+    def export_entry(self, key):
+        if key[0] == "channel":
+            if key[1] not in self.channel_histories:
+                return None
+            return {"memories": list(self.channel_memories.get(key[1], [])), "history": [msg.to_dict() for msg in self.channel_histories[key[1]]]}
+        if key[2] not in self.user_histories.get(key[1], {}):
+            return None
+        return self._user_state(key[1], key[2])
+
+    def _entry_bytes(self, key):
+        if key[0] == "channel":
+            histories = [self.channel_histories.get(key[1], ())]
+            extra = sum(sys.getsizeof(memory) for memory in self.channel_memories.get(key[1], ()))
+        else:
+            histories = [self.user_histories.get(key[1], {}).get(key[2], ())]
+            histories.extend(self.user_model_histories.get(key[1], {}).get(key[2], {}).values())
+            extra = 0
+        # Rough: message object plus content; messages shared between histories are counted in each
+        return extra + sum(64 + sys.getsizeof(msg.content) for history in histories for msg in history)
+
+    # Evict least recently used channels/users that have been idle for max_idle seconds, then keep evicting
+    # (anything idle for at least min_idle) while over max_entries or approximately over max_bytes
+    def evict_idle(self, max_idle=0, max_entries=0, max_bytes=0, min_idle=60):
+        if self.loader is None:
+            return 0
+        now = time.monotonic()
+        total = sum(self._entry_bytes(key) for key in self.access) if max_bytes else 0
+        evicted = 0
+        for key, last in list(self.access.items()):
+            idle = now - last
+            over = (max_entries and len(self.access) > max_entries) or (max_bytes and total > max_bytes)
+            if not (max_idle and idle >= max_idle) and not (over and idle >= min_idle):
+                break
+            if max_bytes:
+                total -= self._entry_bytes(key)
+            if key[0] == "channel":
+                self.evict_channel(key[1])
+            else:
+                self.evict_user(key[1], key[2])
+            evicted += 1
+        return evicted
+
+    def get_summary(self, guild_id, user_id, model_name):
+        return self.summaries.get(str(guild_id), {}).get(str(user_id), {}).get(str(model_name))
+
+    def set_summary(self, guild_id, user_id, model_name, summary, through):
+        guild_id = str(guild_id)
+        user_id = str(user_id)
+        model_name = str(model_name)
+        self.initialize_user(guild_id, user_id)
+        self.summaries[guild_id][user_id][model_name] = {"summary": summary, "through": through}
+        self._notify("summary", guild_id=guild_id, user_id=user_id, model=model_name, summary=summary, through=through)
+
     def get_user_model(self, guild_id, user_id):
         guild_id = str(guild_id)
         user_id = str(user_id)
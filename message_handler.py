@@ -1,12 +1,22 @@
 import discord
-import re
 import logging
 import asyncio
-import aiohttp
+import time
 from io import BytesIO
+from context_builder import ContextBuilder, estimate_tokens
+from image_fetcher import ImageFetcher
+from renderer import ResponseRenderer
+from summarizer import Summarizer
+from metrics import registry
 
 logger = logging.getLogger(__name__)
 
+MESSAGE_SECONDS = registry.histogram("unity_message_seconds", "Time from receiving a chat message to finishing the reply", ["path"])
+CONTEXT_TOKENS = registry.histogram(
+    "unity_context_tokens", "Approximate prompt size sent to the model",
+    buckets=(250, 500, 1000, 2000, 4000, 8000, 16000, 32000),
+)
+
 class MessageHandler:
     def __init__(self, api_client=None, memory_manager=None, config=None, data_manager=None, bot=None):
         self.api_client = api_client
@@ -14,112 +24,198 @@ class MessageHandler:
         self.config = config
         self.data_manager = data_manager
         self.bot = bot
+        self.context_builder = ContextBuilder(memory_manager, config) if memory_manager and config else None
+        self.summarizer = Summarizer(api_client, memory_manager, config, data_manager) if memory_manager and config else None
+        self.debouncer = None
+        self.image_fetcher = ImageFetcher(
+            max_bytes=config.image_max_bytes,
+            timeout=config.image_fetch_timeout,
+            concurrency=config.image_fetch_concurrency,
+            cache_max_bytes=config.image_cache_max_bytes,
+        ) if config else ImageFetcher()
+        self.renderer = ResponseRenderer(file_threshold=config.render_file_threshold) if config else ResponseRenderer()
+
+    # `earlier` holds messages debounced into this one; they are recorded first and answered together
+    async def handle_message(self, message, earlier=()):
+        started = time.perf_counter()
+        path = "error"
+        try:
+            path = await self._handle_message(message, earlier)
+        finally:
+            if self.debouncer is not None:
+                self.debouncer.done(message)
+            if path:
+                MESSAGE_SECONDS.observe(time.perf_counter() - started, path=path)
 
-    async def handle_message(self, message):
+    async def _handle_message(self, message, earlier=()):
         channel_id = str(message.channel.id)
         guild_id = str(message.guild.id) if message.guild else "DM"
         user_id = str(message.author.id)
-        user_message = message.content
-        if user_message.lower().startswith("!"):
-            return
-        self.memory_manager.add_user_message(channel_id, guild_id, user_id, user_message)
+        if message.content.lower().startswith("!"):
+            return None
+        # Admission may have held the message long enough for its state to be evicted again
+        await self.memory_manager.preload(channel_id, guild_id, user_id)
+        for previous in earlier:
+            self.memory_manager.add_user_message(channel_id, guild_id, user_id, previous.content)
+        self.memory_manager.add_user_message(channel_id, guild_id, user_id, message.content)
+        user_message = "\n".join([previous.content for previous in earlier] + [message.content])
+        if self.debouncer is not None and self.debouncer.superseded(message):
+            # A newer message from this user is waiting; its reply will cover these too
+            self.debouncer.stats["superseded"] += 1
+            return "superseded"
         user_model = self.memory_manager.get_user_model(guild_id, user_id)
-        system_prompt = f"{self.config.system_instructions}\nYou are {user_model}."
-        messages = [{"role": "system", "content": system_prompt}]
-        channel_memories = self.memory_manager.channel_memories.get(channel_id, [])
-        if channel_memories:
-            messages.append({"role": "user", "content": "\n".join(channel_memories)})
-        model_history = self.memory_manager.get_user_model_history(guild_id, user_id, user_model)
-        for msg in model_history:
-            if msg["content"].strip():
-                role = "assistant" if msg["role"] == "ai" else msg["role"]
-                messages.append({"role": role, "content": msg["content"]})
+        messages = self.context_builder.build(channel_id, guild_id, user_id, user_model, user_message)
+        CONTEXT_TOKENS.observe(sum(estimate_tokens(m["content"]) for m in messages))
         logger.info(f"Preparing to send message for user {user_id} with model {user_model}")
         if not self.api_client:
             await message.channel.send(f"<@{user_id}> Error: API client not initialized")
             logger.error(f"API client is None for user {user_id}")
-            return
+            return "error"
+        if self.config.stream_responses:
+            try:
+                if await self._stream_reply(message, user_id, messages, user_model, user_message.lower()):
+                    return "stream"
+            except Exception as e:
+                logger.error(f"Streaming reply failed for user {user_id}: {e}")
         try:
-            ai_response = await self.api_client.send_message(messages, user_model)
+            if self.debouncer is not None:
+                ai_response = await self.debouncer.run(message, self.api_client.send_message(messages, user_model))
+                if ai_response is None:
+                    return "superseded"
+            else:
+                ai_response = await self.api_client.send_message(messages, user_model)
             if not ai_response or not ai_response.strip():
                 await message.channel.send(f"<@{user_id}> Error: Empty response from API")
-                return
+                return "error"
         except Exception as e:
             await message.channel.send(f"<@{user_id}> Error: Failed to fetch response - {e}")
-            return
+            return "error"
         ai_response_clean = self.clean_response(ai_response)
         if not ai_response_clean:
             ai_response_clean = "Empty response from API—please try again later."
         final_message = self.build_message(ai_response_clean)
         try:
-            await self._send_message(message, user_id, final_message, user_message.lower())
+            return await self._send_message(message, user_id, final_message)
         except Exception as e:
             logger.error(f"Failed to send message for user {user_id}: {e}")
             await message.channel.send(f"<@{user_id}> Failed to send response - please try again.")
+            return "error"
+
+    async def _stream_reply(self, message, user_id, messages, user_model, user_message):
+        prefix = f"<@{user_id}> "
+        sent = []
+        rendered = []
+        text = ""
+        # Nothing is visible yet if the placeholder can't be sent, so this may still fall back
+        await self._render_stream(message, sent, rendered, self._raw_chunks(f"{prefix}…"))
+        loop = asyncio.get_running_loop()
+        last_edit = loop.time()
+        stream = self.api_client.stream_message(messages, user_model)
+        try:
+            async for delta in stream:
+                text += delta
+                now = loop.time()
+                if now - last_edit >= self.config.stream_edit_interval:
+                    if not await self._update_stream(message, user_id, sent, rendered, self._raw_chunks(f"{prefix}{text}")):
+                        return True
+                    last_edit = now
+        except Exception as e:
+            if not text.strip():
+                logger.warning(f"Streaming failed before any text for user {user_id}, falling back: {e}")
+                await self._delete_messages(sent)
+                return False
+            logger.error(f"Stream interrupted for user {user_id}, keeping partial reply: {e}")
+        finally:
+            await stream.aclose()
+        if not text.strip():
+            await self._delete_messages(sent)
+            return False
+        ai_response_clean = self.clean_response(text)
+        if not ai_response_clean:
+            ai_response_clean = "Empty response from API—please try again later."
+        final_message = self.build_message(ai_response_clean)
+        chunks, attachments = self.renderer.pack(final_message["blocks"], prefix)
+        if final_message["image_urls"] or attachments:
+            await self._delete_messages(sent)
+            try:
+                await self._send_message(message, user_id, final_message)
+            except Exception as e:
+                logger.error(f"Failed to send streamed reply with attachments for user {user_id}: {e}")
+            return True
+        content = final_message["content"]
+        if not await self._update_stream(message, user_id, sent, rendered, chunks):
+            return True
+        logger.info(f"Streamed response length for user {user_id}: {len(content)} characters in {len(sent)} message(s)")
+        if content.strip():
+            guild_id = str(message.guild.id) if message.guild else "DM"
+            self.memory_manager.add_ai_message(str(message.channel.id), guild_id, user_id, content)
+        return True
+
+    # A Discord error once the reply is visible ends it here; falling back would post it twice
+    async def _update_stream(self, message, user_id, sent, rendered, chunks):
+        try:
+            await self._render_stream(message, sent, rendered, chunks)
+            return True
+        except Exception as e:
+            logger.error(f"Failed to update streamed reply for user {user_id}, removing it: {e}")
+            await self._delete_messages(sent)
+            return False
+
+    def _raw_chunks(self, text):
+        limit = self.renderer.limit
+        return [text[i:i + limit] for i in range(0, len(text), limit)] or [text]
+
+    async def _render_stream(self, message, sent, rendered, chunks):
+        for idx, chunk in enumerate(chunks):
+            if idx < len(sent):
+                if rendered[idx] != chunk:
+                    await sent[idx].edit(content=chunk)
+                    rendered[idx] = chunk
+            else:
+                sent.append(await message.channel.send(chunk))
+                rendered.append(chunk)
+        if len(sent) > len(chunks):
+            await self._delete_messages(sent[len(chunks):])
+            del sent[len(chunks):]
+            del rendered[len(chunks):]
+
+    async def _delete_messages(self, sent):
+        for msg in sent:
+            try:
+                await msg.delete()
+            except Exception as e:
+                logger.error(f"Failed to delete streamed message: {e}")
 
     def clean_response(self, response: str) -> str:
-        response = response.strip()
-        response = re.sub(r"\n{3,}", "\n\n", response)
-        cleaned_lines = [line for line in response.split("\n") if not re.match(r"^---", line) and "Generated by" not in line and not re.search(r"\d{4}-\d{2}-\d{2}", line)]
-        return "\n".join(cleaned_lines).strip()
+        return self.renderer.clean(response)
 
     def build_message(self, content: str) -> dict:
-        url_pattern = r"https?://\S+"
-        image_urls = re.findall(url_pattern, content)
-        content_without_urls = re.sub(url_pattern, "", content).strip()
-        return {"content": content_without_urls, "image_urls": image_urls}
+        return self.renderer.parse(content)
 
-    async def _send_message(self, message, user_id, final_message, user_message):
+    async def _send_message(self, message, user_id, final_message):
         content = final_message["content"]
         image_urls = final_message["image_urls"]
         guild_id = str(message.guild.id) if message.guild else "DM"
-        files = []
-        if image_urls:
-            async with aiohttp.ClientSession() as session:
-                for url in image_urls:
-                    try:
-                        async with session.get(url) as resp:
-                            if resp.status == 200:
-                                data = await resp.read()
-                                files.append(discord.File(BytesIO(data), filename="image.png"))
-                            else:
-                                logger.error(f"Failed to fetch image from {url}: status {resp.status}")
-                    except Exception as e:
-                        logger.error(f"Error fetching image from {url}: {e}")
-
-        if content or files:
-            prefixed_content = f"<@{user_id}> {content}" if content else f"<@{user_id}>"
-            content_length = len(prefixed_content)
-            logger.info(f"Response length for user {user_id}: {content_length} characters")
-            if 'code' in user_message or 'script' in user_message:
-                code_blocks = re.findall(r'\[CODE\]\s*(\w+)\s*([\s\S]*?)\[/CODE\]', prefixed_content, re.DOTALL)
-                for lang, code in code_blocks:
-                    code_content = f"```{lang}\n{code.strip()}\n```"
-                    if len(code_content) <= 2000:
-                        await message.channel.send(code_content)
-                    elif len(code_content) <= 4096:
-                        embed = discord.Embed(description=code_content[:4096])
-                        await message.channel.send(embed=embed)
-                    else:
-                        buffer = BytesIO(code_content.encode('utf-8'))
-                        file = discord.File(buffer, filename=f"{lang}_code.txt")
-                        await message.channel.send(f"<@{user_id}> Code too long, attached as file:", file=file)
-                prefixed_content = re.sub(r'\[CODE\][\s\S]*?\[/CODE\]', '', prefixed_content).strip()
-                content_length = len(prefixed_content)
-
-            if content_length > 0 or files:
-                if content_length <= 2000:
-                    await message.channel.send(prefixed_content, files=files if files else None)
-                elif content_length <= 4096:
-                    embed = discord.Embed(description=prefixed_content[:4096])
-                    await message.channel.send(embed=embed, files=files if files else None)
-                else:
-                    buffer = BytesIO(prefixed_content.encode('utf-8'))
-                    text_file = discord.File(buffer, filename="response.txt")
-                    files.append(text_file)
-                    await message.channel.send(f"<@{user_id}> Response too long, attached as file and images:", files=files)
-            elif files:  # If no content but images exist
-                await message.channel.send(f"<@{user_id}>", files=files)
+        image_task = asyncio.ensure_future(self.image_fetcher.fetch_all(image_urls)) if image_urls else None
+
+        try:
+            chunks, attachments = self.renderer.pack(final_message["blocks"], f"<@{user_id}>")
+            logger.info(f"Response length for user {user_id}: {len(content)} characters in {len(chunks)} message(s)")
+            for chunk in chunks[:-1]:
+                await message.channel.send(chunk)
+
+            files = []
+            if image_task is not None:
+                images = await image_task
+                files = [discord.File(BytesIO(data), filename=f"image_{idx}.{ext}") for idx, (data, ext) in enumerate(images, start=1)]
+            files.extend(discord.File(BytesIO(text.encode("utf-8")), filename=name) for name, text in attachments)
+            if content or files:
+                await message.channel.send(chunks[-1], files=files if files else None)
+        finally:
+            # Don't leave the downloads running when a send fails or the reply is cancelled
+            if image_task is not None and not image_task.done():
+                image_task.cancel()
 
         if content.strip():
             self.memory_manager.add_ai_message(str(message.channel.id), guild_id, user_id, content)
+        return "attachments" if files else "send"
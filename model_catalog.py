@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODELS = [{"name": "unity", "description": "Default unity model"}]
+
+# Model list kept on disk so startup never waits on the models endpoint: the cached copy (or the
+# default model) is used straight away and refreshed in the background once it is older than ttl.
+class ModelCatalog:
+    def __init__(self, api_client, memory_manager, filename, ttl=3600, retry_interval=300):
+        self.api_client = api_client
+        self.memory_manager = memory_manager
+        self.filename = filename
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self.fetched_at = 0.0
+        self.stats = {"refreshes": 0, "changes": 0, "failures": 0}
+        self._task = None
+
+    @property
+    def models(self):
+        return self.memory_manager.models
+
+    def age(self):
+        return time.time() - self.fetched_at
+
+    def load(self):
+        models = None
+        try:
+            with open(self.filename, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            models = data["models"]
+            self.fetched_at = float(data.get("fetched_at", 0))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable model cache {self.filename}: {e}")
+        if models:
+            self.memory_manager.set_models(models)
+            logger.info(f"Loaded {len(models)} cached models ({self.age():.0f}s old)")
+        elif not self.memory_manager.models:
+            self.memory_manager.set_models(list(DEFAULT_MODELS))
+            logger.info("No cached model list; using the default model until the catalog is fetched")
+        return self.models
+
+    def start(self):
+        if self._task is not None and not self._task.done():
+            return
+        self._task = asyncio.create_task(self._refresh_periodically())
+
+    async def _refresh_periodically(self):
+        while True:
+            try:
+                await asyncio.sleep(max(self.fetched_at + self.ttl - time.time(), 0))
+                if not await self.refresh():
+                    await asyncio.sleep(self.retry_interval)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Error refreshing model catalog: {e}")
+                await asyncio.sleep(self.retry_interval)
+
+    async def refresh(self):
+        self.stats["refreshes"] += 1
+        models = await self.api_client.fetch_models()
+        if not models:
+            self.stats["failures"] += 1
+            logger.warning(f"Model catalog refresh failed; keeping {len(self.models)} models from {self.age():.0f}s ago")
+            return False
+        self.fetched_at = time.time()
+        if models != self.models:
+            self.stats["changes"] += 1
+            self.memory_manager.set_models(models)
+            logger.info(f"Model catalog updated: {[m['name'] for m in models]}")
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, models, self.fetched_at)
+        except Exception as e:
+            logger.error(f"Error saving model cache {self.filename}: {e}")
+        return True
+
+    def _write(self, models, fetched_at):
+        # Shard processes share the file, so write a private temp file and swap it in
+        temp = f"{self.filename}.{os.getpid()}.tmp"
+        with open(temp, "w", encoding="utf-8") as f:
+            json.dump({"fetched_at": fetched_at, "models": models}, f, indent=4)
+        os.replace(temp, self.filename)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,125 @@
+import os
+import json
+import logging
+from snapshot_store import SnapshotDataManager, CHANNEL_BUCKETS, decode_section, encode_section, partition
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = "manifest.json"
+VERSION = 1
+
+# A directory with one file per partition (the users of one guild or of DMs, or a bucket of channels, named
+# as in snapshot_store) and a manifest naming the current file of each. Files are never rewritten in place:
+# a save writes new generation-numbered files for the partitions it covers and then swaps the manifest, so
+# a crash part way through leaves the previous save intact.
+class PartitionDirectory:
+    def __init__(self, dirname):
+        self.dirname = dirname
+        with open(os.path.join(dirname, MANIFEST), "r") as f:
+            manifest = json.load(f)
+        if manifest.get("version", 0) > VERSION:
+            raise ValueError(f"{dirname} uses partition format {manifest['version']}; this version reads up to {VERSION}")
+        self.generation = manifest["generation"]
+        self.buckets = manifest["channel_buckets"]
+        # partition name -> file name
+        self.sections = manifest["partitions"]
+        # (generation, sections) written but not yet swapped in
+        self.pending = None
+
+    @staticmethod
+    def create(dirname, buckets=CHANNEL_BUCKETS):
+        os.makedirs(dirname, exist_ok=True)
+        with open(os.path.join(dirname, MANIFEST), "w") as f:
+            json.dump({"version": VERSION, "generation": 0, "channel_buckets": buckets, "partitions": {}}, f)
+
+    def read(self, name):
+        with open(os.path.join(self.dirname, self.sections[name]), "rb") as f:
+            return decode_section(f.read())
+
+    # Writes new partition files and the manifest naming them; safe in a worker thread, as readers keep using
+    # the current files until swap() is called on the event loop
+    def write(self, payloads):
+        if not payloads:
+            return 0
+        generation = self.generation + 1
+        sections = dict(self.sections)
+        size = 0
+        for name, payload in payloads.items():
+            filename = f"{name.replace(':', '-')}.{generation}.part"
+            with open(os.path.join(self.dirname, filename), "wb") as f:
+                f.write(payload)
+            sections[name] = filename
+            size += len(payload)
+        manifest = json.dumps({"version": VERSION, "generation": generation, "channel_buckets": self.buckets, "partitions": sections}, separators=(",", ":"))
+        tmp_filename = os.path.join(self.dirname, f"{MANIFEST}.tmp")
+        with open(tmp_filename, "w") as f:
+            f.write(manifest)
+        os.replace(tmp_filename, os.path.join(self.dirname, MANIFEST))
+        self.pending = (generation, sections)
+        return size + len(manifest)
+
+    # Switches readers to the files of the last write() and removes the ones they replaced
+    def swap(self):
+        if self.pending is None:
+            return
+        (generation, sections), self.pending = self.pending, None
+        replaced = [self.sections[name] for name in sections if name in self.sections and self.sections[name] != sections[name]]
+        self.generation = generation
+        self.sections = sections
+        for filename in replaced:
+            self._remove(filename)
+
+    # Partition files left behind by a save that never reached its manifest swap
+    def remove_stale(self):
+        current = set(self.sections.values())
+        stale = [name for name in os.listdir(self.dirname) if name.endswith(".part") and name not in current]
+        for filename in stale:
+            self._remove(filename)
+        return len(stale)
+
+    def _remove(self, filename):
+        try:
+            os.remove(os.path.join(self.dirname, filename))
+        except OSError as e:
+            logger.warning(f"Could not remove old partition file {filename}: {e}")
+
+    def close(self):
+        pass
+
+
+# Keeps chat data in logs/chat_data/ split by guild (DMs together) and channel bucket, read on demand like
+# the snapshot backend. A save writes only the partitions holding changed channels/users, so its cost
+# follows what changed rather than how many servers the bot is in.
+class PartitionedDataManager(SnapshotDataManager):
+    backend = "partitioned"
+    save_op = "partitions"
+
+    def __init__(self, filename, json_filename=None, flush_interval=0, compress=True):
+        super().__init__(filename, json_filename=json_filename, flush_interval=flush_interval, compress=compress)
+        self.stats.pop("sections_copied")
+        self.stats["stale_files"] = 0
+
+    def _create_file(self):
+        PartitionDirectory.create(self.filename)
+
+    def _open(self):
+        self.snapshot = PartitionDirectory(self.filename)
+        self.buckets = self.snapshot.buckets
+        self.stats["stale_files"] += self.snapshot.remove_stale()
+
+    def _import_json(self):
+        with open(self.json_filename, "r") as f:
+            data = json.loads(f.read())
+        payloads = {name: encode_section(section, self.compress) for name, section in partition(data, self.buckets).items() if name != "meta"}
+        size = self.snapshot.write(payloads)
+        self.snapshot.swap()
+        return size
+
+    def _write_sections(self, sections):
+        size = self.snapshot.write({name: encode_section(section, self.compress) for name, section in sections.items()})
+        self.stats["sections_encoded"] += len(sections)
+        return size
+
+    # Back on the event loop, so no load can be reading a file that is about to be removed
+    def _commit(self):
+        self.snapshot.swap()
@@ -0,0 +1,171 @@
+import time
+import asyncio
+import logging
+import datetime
+from email.utils import parsedate_to_datetime
+
+logger = logging.getLogger(__name__)
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    return max((retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0.0)
+
+# A rate of 0 turns the pacing off; a Retry-After from upstream is still honoured
+class AdaptiveRateLimiter:
+    def __init__(self, rate=2.0, burst=5, min_rate=0.1, increase=0.05):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.increase = increase
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.stats = {"acquired": 0, "waited": 0, "wait_time": 0.0, "throttled": 0}
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        waited = 0.0
+        while True:
+            now = time.monotonic()
+            self._refill(now)
+            delay = self.blocked_until - now
+            if delay <= 0 and self.max_rate <= 0:
+                break
+            if delay <= 0 and self.tokens >= 1:
+                self.tokens -= 1
+                break
+            if self.max_rate > 0:
+                delay = max(delay, (1 - self.tokens) / self.rate)
+            waited += delay
+            await asyncio.sleep(delay)
+        self.stats["acquired"] += 1
+        if waited:
+            self.stats["waited"] += 1
+            self.stats["wait_time"] += waited
+
+    def on_success(self):
+        self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttled(self, retry_after=None):
+        self.stats["throttled"] += 1
+        if self.max_rate > 0:
+            self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = 0.0
+        if retry_after:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+        lowered = f"; request rate lowered to {self.rate:.2f}/s" if self.max_rate > 0 else ""
+        logger.warning(f"Upstream throttled{lowered}" + (f", paused {retry_after:.1f}s" if retry_after else ""))
+
+    def snapshot(self):
+        return {"rate": self.rate, "tokens": self.tokens, "blocked_for": max(self.blocked_until - time.monotonic(), 0.0), **self.stats}
+
+# Non-blocking bucket for admission checks: callers drop the work instead of waiting for a token
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def try_acquire(self, now=None):
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def full(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, cooldown=30, probe_timeout=60, name="upstream"):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        # A half-open probe that reports nothing for this long no longer blocks the next one
+        self.probe_timeout = probe_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.probe_started = 0.0
+        self.stats = {"opened": 0, "rejected": 0}
+
+    def retry_in(self):
+        return max(self.opened_at + self.cooldown - time.monotonic(), 0.0)
+
+    def _probe_free(self):
+        return not self.probe_in_flight or time.monotonic() - self.probe_started > self.probe_timeout
+
+    # Whether allow() would let a request through, without taking the probe; lets callers fail fast
+    # before queueing for a slot or a rate limit token
+    def ready(self):
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return self.retry_in() <= 0
+        return self._probe_free()
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and self.retry_in() <= 0:
+            self.state = self.HALF_OPEN
+            self.probe_in_flight = False
+            logger.info(f"Circuit breaker for {self.name} half-open; probing")
+        if self.state == self.HALF_OPEN and self._probe_free():
+            self.probe_in_flight = True
+            self.probe_started = time.monotonic()
+            return True
+        self.stats["rejected"] += 1
+        return False
+
+    @property
+    def probing(self):
+        return self.state == self.HALF_OPEN
+
+    # The probe ended without an outcome (e.g. it was cancelled); let the next request probe instead
+    def abandon_probe(self):
+        if self.state == self.HALF_OPEN:
+            self.probe_in_flight = False
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info(f"Circuit breaker for {self.name} closed; recovered")
+        self.state = self.CLOSED
+        self.failures = 0
+        self.probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.stats["opened"] += 1
+                logger.error(f"Circuit breaker for {self.name} open after {self.failures} failures; failing fast for {self.cooldown}s")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.probe_in_flight = False
+
+    def snapshot(self):
+        return {"state": self.state, "failures": self.failures, "retry_in": self.retry_in() if self.state == self.OPEN else 0.0, **self.stats}
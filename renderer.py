@@ -0,0 +1,160 @@
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Patterns lead with a literal so the regex engine can skip ahead instead of
+# attempting a match at every character of long replies.
+BLANK_LINES = re.compile(r"\n\n\n+")
+DROP_MARKERS = re.compile(r"---|Generated by|-\d\d-\d\d(?<=\d{4}-\d\d-\d\d)")
+OPENERS = re.compile(r"\[CODE\]|```|https?://")
+TOKENS = {
+    "[": re.compile(r"\[CODE\]\s*(?P<lang>\w+)\s*(?P<code>[\s\S]*?)\[/CODE\]"),
+    "`": re.compile(r"```(?P<lang>\w*)\n(?P<code>[\s\S]*?)\n?```"),
+    "h": re.compile(r"https?://\S+"),
+}
+PARAGRAPHS = re.compile(r"\n\s*\n")
+
+class ResponseRenderer:
+    def __init__(self, limit=2000, file_threshold=8000):
+        self.limit = limit
+        self.file_threshold = file_threshold
+
+    def clean(self, text):
+        text = BLANK_LINES.sub("\n\n", text.strip())
+        kept = []
+        pos = 0
+        for match in DROP_MARKERS.finditer(text):
+            start = text.rfind("\n", 0, match.start()) + 1
+            if start < pos or (match.group(0) == "---" and start != match.start()):
+                continue
+            end = text.find("\n", match.end())
+            kept.append(text[pos:start])
+            pos = len(text) if end == -1 else end + 1
+        kept.append(text[pos:])
+        return "".join(kept).strip()
+
+    def parse(self, text):
+        blocks = []
+        image_urls = []
+        kept = []
+        pending = []
+        pos = 0
+        search_from = 0
+        while True:
+            opener = OPENERS.search(text, search_from)
+            if opener is None:
+                break
+            start = opener.start()
+            match = TOKENS[text[start]].match(text, start)
+            if match is None:
+                search_from = start + 1
+                continue
+            search_from = match.end()
+            if start > pos:
+                pending.append(text[pos:start])
+                kept.append(text[pos:start])
+            pos = match.end()
+            if text[start] == "h":
+                image_urls.append(match.group(0))
+                continue
+            kept.append(match.group(0))
+            if pending:
+                blocks.append(("text", "".join(pending)))
+                pending = []
+            code = match.group("code")
+            blocks.append(("code", match.group("lang"), code.strip() if text[start] == "[" else code.strip("\n")))
+        if pos < len(text):
+            pending.append(text[pos:])
+            kept.append(text[pos:])
+        if pending:
+            blocks.append(("text", "".join(pending)))
+        return {"content": "".join(kept).strip(), "image_urls": image_urls, "blocks": blocks}
+
+    def pack(self, blocks, prefix=""):
+        prefix = prefix.strip()
+        max_len = self.limit - len(prefix) - 1
+        pieces = []
+        files = []
+        for block in blocks:
+            if block[0] == "text":
+                for paragraph in PARAGRAPHS.split(block[1]):
+                    paragraph = paragraph.strip()
+                    if paragraph:
+                        pieces.extend(self._split_text(paragraph, max_len))
+                continue
+            _, lang, code = block
+            if not code:
+                continue
+            fenced = f"```{lang}\n{code}\n```"
+            if len(fenced) > self.file_threshold:
+                files.append((f"{lang or 'text'}_code.txt", fenced))
+            else:
+                pieces.extend(self._split_code(lang, code, max_len))
+        full_text = "\n\n".join(pieces)
+        if len(full_text) > self.file_threshold:
+            logger.info(f"Rendered reply is {len(full_text)} characters; attaching as file")
+            return [f"{prefix} Response too long, attached as file:".strip()], [("response.txt", full_text)] + files
+        messages = []
+        current = prefix
+        for piece in pieces:
+            if current == prefix:
+                sep = ("\n" if piece.startswith("```") else " ") if prefix else ""
+            else:
+                sep = "\n\n"
+            if len(current) + len(sep) + len(piece) <= self.limit:
+                current = f"{current}{sep}{piece}"
+            else:
+                messages.append(current)
+                current = piece
+        if current and (current != prefix or not messages):
+            messages.append(current)
+        if files and len(messages) == 1 and messages[0] == prefix:
+            messages[0] = f"{prefix} Code too long, attached as file:".strip()
+        return messages, files
+
+    def _split_text(self, text, max_len):
+        if len(text) <= max_len:
+            return [text]
+        chunks = []
+        current = ""
+        for line in text.split("\n"):
+            while len(line) > max_len:
+                cut = line.rfind(" ", 0, max_len)
+                if cut <= 0:
+                    cut = max_len
+                if current:
+                    chunks.append(current)
+                    current = ""
+                chunks.append(line[:cut])
+                line = line[cut:].lstrip()
+            if current and len(current) + 1 + len(line) > max_len:
+                chunks.append(current)
+                current = line
+            else:
+                current = f"{current}\n{line}" if current else line
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def _split_code(self, lang, code, max_len):
+        opening = f"```{lang}\n"
+        budget = max_len - len(opening) - len("\n```")
+        chunks = []
+        current = []
+        size = 0
+        for line in code.split("\n"):
+            while len(line) > budget:
+                if current:
+                    chunks.append(current)
+                    current, size = [], 0
+                chunks.append([line[:budget]])
+                line = line[budget:]
+            if current and size + 1 + len(line) > budget:
+                chunks.append(current)
+                current, size = [], 0
+            size += len(line) + (1 if current else 0)
+            current.append(line)
+        if current:
+            chunks.append(current)
+        return [opening + "\n".join(lines) + "\n```" for lines in chunks]
@@ -0,0 +1,86 @@
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+class ResponseCache:
+    def __init__(self, max_entries=256, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        # fill task -> callers still waiting on it
+        self.waiters = {}
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "stores": 0, "evictions": 0, "expired": 0, "abandoned": 0}
+
+    @staticmethod
+    def make_key(model, messages, temperature, max_tokens):
+        normalized = [(m.get("role"), " ".join(str(m.get("content", "")).split())) for m in messages]
+        raw = json.dumps([model, normalized, temperature, max_tokens], separators=(",", ":"))
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            self.stats["expired"] += 1
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        self.stats["stores"] += 1
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    async def run(self, key, factory, cacheable=False):
+        if cacheable:
+            value = self.get(key)
+            if value is not None:
+                self.stats["hits"] += 1
+                logger.debug(f"Response cache hit {key[:12]}")
+                return value
+        task = self.in_flight.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+            logger.debug(f"Joining in-flight request {key[:12]}")
+        else:
+            self.stats["misses"] += 1
+            task = asyncio.get_running_loop().create_task(self._fill(key, factory, cacheable))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self.in_flight[key] = task
+        self.waiters[task] = self.waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # Shielded so one caller leaving doesn't fail the others; once the last one leaves, stop the request
+            if self.waiters[task] == 1 and not task.done():
+                task.cancel()
+                self.stats["abandoned"] += 1
+            raise
+        finally:
+            self.waiters[task] -= 1
+            if not self.waiters[task]:
+                del self.waiters[task]
+
+    async def _fill(self, key, factory, cacheable):
+        try:
+            value = await factory()
+        finally:
+            self.in_flight.pop(key, None)
+        if cacheable and isinstance(value, str) and value.strip() and not value.startswith("Error:"):
+            self.put(key, value)
+        return value
+
+    def snapshot(self):
+        return {"entries": len(self.entries), "in_flight": len(self.in_flight), **self.stats}
@@ -0,0 +1,80 @@
+import time
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+class EndpointRouter:
+    def __init__(self, endpoints, fallbacks=None, hedge_delay=10.0, window=100, min_samples=10, failure_threshold=3, demote_for=60):
+        self.endpoints = list(endpoints)
+        self.fallbacks = fallbacks or {}
+        self.default_hedge_delay = hedge_delay
+        self.window = window
+        self.min_samples = min_samples
+        self.failure_threshold = failure_threshold
+        self.demote_for = demote_for
+        self.latencies = {}
+        self.failures = {endpoint: 0 for endpoint in self.endpoints}
+        self.demoted_until = {endpoint: 0.0 for endpoint in self.endpoints}
+        self.stats = {"hedged": 0, "hedge_wins": 0, "failovers": 0, "demotions": 0}
+
+    def record_success(self, endpoint, model, latency):
+        self.latencies.setdefault((endpoint, model), deque(maxlen=self.window)).append(latency)
+        if self.failures.get(endpoint):
+            logger.info(f"Endpoint {self._label(endpoint)} recovered")
+        self.failures[endpoint] = 0
+        self.demoted_until[endpoint] = 0.0
+
+    def record_failure(self, endpoint, model):
+        self.failures[endpoint] = self.failures.get(endpoint, 0) + 1
+        if self.failures[endpoint] >= self.failure_threshold and not self.is_demoted(endpoint):
+            self.demoted_until[endpoint] = time.monotonic() + self.demote_for
+            self.stats["demotions"] += 1
+            logger.warning(f"Demoting endpoint {self._label(endpoint)} for {self.demote_for}s after {self.failures[endpoint]} failures")
+
+    def is_demoted(self, endpoint):
+        return self.demoted_until.get(endpoint, 0.0) > time.monotonic()
+
+    def percentile(self, endpoint, model, q):
+        samples = self.latencies.get((endpoint, model))
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+    def hedge_delay(self, endpoint, model):
+        p95 = self.percentile(endpoint, model, 0.95)
+        return p95 if p95 is not None else self.default_hedge_delay
+
+    def routes(self, model):
+        def rank(item):
+            index, endpoint = item
+            p50 = self.percentile(endpoint, model, 0.5)
+            return (self.is_demoted(endpoint), p50 if p50 is not None else float("inf"), index)
+        ordered = [endpoint for _, endpoint in sorted(enumerate(self.endpoints), key=rank)]
+        routes = [(endpoint, model) for endpoint in ordered]
+        routes.extend((ordered[0], fallback) for fallback in self.fallbacks.get(model.lower(), []))
+        return routes
+
+    def _label(self, endpoint):
+        return endpoint.split("?")[0]
+
+    def snapshot(self):
+        return {
+            "endpoints": {
+                self._label(endpoint): {
+                    "failures": self.failures.get(endpoint, 0),
+                    "demoted": self.is_demoted(endpoint),
+                }
+                for endpoint in self.endpoints
+            },
+            "latency": {
+                f"{self._label(endpoint)}|{model}": {
+                    "p50": self.percentile(endpoint, model, 0.5),
+                    "p95": self.percentile(endpoint, model, 0.95),
+                    "samples": len(samples),
+                }
+                for (endpoint, model), samples in self.latencies.items()
+            },
+            **self.stats,
+        }
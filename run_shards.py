@@ -0,0 +1,89 @@
+import os
+import sys
+import signal
+import asyncio
+import logging
+import argparse
+import aiohttp
+from config import Config
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+logger = logging.getLogger("run_shards")
+
+GATEWAY_URL = "https://discord.com/api/v10/gateway/bot"
+
+async def recommended_shards(token):
+    async with aiohttp.ClientSession() as session:
+        async with session.get(GATEWAY_URL, headers={"Authorization": f"Bot {token}"}) as resp:
+            resp.raise_for_status()
+            data = await resp.json()
+    return data["shards"]
+
+def split_shards(shard_count, processes):
+    processes = max(1, min(processes, shard_count))
+    base, extra = divmod(shard_count, processes)
+    groups = []
+    start = 0
+    for index in range(processes):
+        size = base + (1 if index < extra else 0)
+        groups.append(list(range(start, start + size)))
+        start += size
+    return groups
+
+async def run_process(shard_ids, shard_count, stopping):
+    env = {**os.environ, "SHARD_IDS": ",".join(map(str, shard_ids)), "SHARD_COUNT": str(shard_count)}
+    env.pop("SHARDING", None)
+    label = f"shards {shard_ids[0]}-{shard_ids[-1]}"
+    backoff = 5
+    while not stopping.is_set():
+        logger.info(f"Starting {label}")
+        proc = await asyncio.create_subprocess_exec(sys.executable, "bot.py", env=env)
+        stop_wait = asyncio.ensure_future(stopping.wait())
+        exit_wait = asyncio.ensure_future(proc.wait())
+        await asyncio.wait({stop_wait, exit_wait}, return_when=asyncio.FIRST_COMPLETED)
+        if stopping.is_set():
+            exit_wait.cancel()
+            if proc.returncode is None:
+                proc.send_signal(signal.SIGINT)
+                try:
+                    await asyncio.wait_for(proc.wait(), timeout=30)
+                except asyncio.TimeoutError:
+                    logger.warning(f"{label} did not stop in time; killing it")
+                    proc.kill()
+                    await proc.wait()
+            logger.info(f"Stopped {label}")
+            return
+        stop_wait.cancel()
+        logger.error(f"{label} exited with code {proc.returncode}; restarting in {backoff}s")
+        try:
+            await asyncio.wait_for(stopping.wait(), timeout=backoff)
+        except asyncio.TimeoutError:
+            pass
+        backoff = min(backoff * 2, 300)
+
+async def main():
+    parser = argparse.ArgumentParser(description="Run the bot as several shard processes sharing logs/chat_data.db")
+    parser.add_argument("--shards", type=int, default=int(os.getenv("SHARD_COUNT", "0")), help="total shard count (default: Discord's recommendation)")
+    parser.add_argument("--processes", type=int, default=int(os.getenv("SHARD_PROCESSES", str(os.cpu_count() or 1))))
+    args = parser.parse_args()
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    shard_count = args.shards
+    if shard_count <= 0:
+        os.environ.pop("SHARD_IDS", None)
+        shard_count = await recommended_shards(Config().discord_token)
+        logger.info(f"Discord recommends {shard_count} shards")
+    groups = split_shards(shard_count, args.processes)
+    logger.info(f"Running {shard_count} shards in {len(groups)} processes: {groups}")
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stopping.set)
+        except NotImplementedError:
+            pass
+    await asyncio.gather(*(run_process(shard_ids, shard_count, stopping) for shard_ids in groups))
+
+if __name__ == "__main__":
+    asyncio.run(main())
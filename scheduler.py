@@ -0,0 +1,83 @@
+import asyncio
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+class MessageScheduler:
+    def __init__(self):
+        self.queues = {}
+        self.workers = {}
+        self.timers = set()
+        self.stats = {"submitted": 0, "deferred": 0, "started": 0, "completed": 0, "failed": 0, "total_wait": 0.0, "max_wait": 0.0}
+
+    def submit(self, key, job, delay=0):
+        key = str(key)
+        self.stats["submitted"] += 1
+        loop = asyncio.get_running_loop()
+        if delay > 0:
+            self.stats["deferred"] += 1
+            handle = None
+
+            def fire():
+                self.timers.discard(handle)
+                self._enqueue(key, job)
+
+            handle = loop.call_later(delay, fire)
+            self.timers.add(handle)
+            return
+        self._enqueue(key, job)
+
+    def _enqueue(self, key, job):
+        loop = asyncio.get_running_loop()
+        self.queues.setdefault(key, deque()).append((loop.time(), job))
+        if key not in self.workers:
+            self.workers[key] = loop.create_task(self._drain(key))
+
+    async def _drain(self, key):
+        queue = self.queues[key]
+        loop = asyncio.get_running_loop()
+        try:
+            while queue:
+                enqueued_at, job = queue.popleft()
+                wait = loop.time() - enqueued_at
+                self.stats["started"] += 1
+                self.stats["total_wait"] += wait
+                self.stats["max_wait"] = max(self.stats["max_wait"], wait)
+                try:
+                    await job()
+                    self.stats["completed"] += 1
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.stats["failed"] += 1
+                    logger.error(f"Scheduled job for {key} failed: {e}")
+        finally:
+            self.workers.pop(key, None)
+            if not queue:
+                self.queues.pop(key, None)
+
+    def depth(self, key=None):
+        if key is not None:
+            return len(self.queues.get(str(key), ()))
+        return sum(len(queue) for queue in self.queues.values())
+
+    def snapshot(self):
+        started = self.stats["started"]
+        return {
+            "depth": self.depth(),
+            "active_queues": len(self.workers),
+            "pending_deferred": len(self.timers),
+            "avg_wait": self.stats["total_wait"] / started if started else 0.0,
+            **self.stats,
+        }
+
+    async def close(self):
+        for handle in self.timers:
+            handle.cancel()
+        self.timers.clear()
+        workers = list(self.workers.values())
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        logger.info(f"Scheduler stats: {self.snapshot()}")
@@ -0,0 +1,375 @@
+import os
+import sys
+import json
+import mmap
+import time
+import zlib
+import struct
+import asyncio
+import logging
+import argparse
+from collections import OrderedDict
+from data_manager import DataManager, SAVE_SECONDS, SAVE_BYTES
+
+logger = logging.getLogger(__name__)
+
+# File layout: header, then sections (4-byte length + payload), then a JSON index of
+# section name -> [payload offset, payload length] that the header points at.
+MAGIC = b"UNITYSNP"
+VERSION = 1
+HEADER = struct.Struct("<8sHHQQ")  # magic, format version, flags (unused), index offset, index length
+SECTION_LENGTH = struct.Struct("<I")
+CHANNEL_BUCKETS = 64
+USER_KEYS = ("user_models", "user_histories", "user_model_histories", "summaries")
+
+# First byte of each section payload says how the JSON after it is stored
+RAW = b"j"
+ZLIB = b"z"
+
+# Users are stored one section per guild ("DM" included). Channel histories carry no guild id,
+# so channels are spread over a fixed number of buckets by id instead.
+def guild_section(guild_id):
+    return f"guild:{guild_id}"
+
+def channel_section(channel_id, buckets=CHANNEL_BUCKETS):
+    return f"channels:{zlib.crc32(channel_id.encode('utf-8')) % buckets}"
+
+def entry_section(key, buckets=CHANNEL_BUCKETS):
+    # key as in MemoryManager.access: ("channel", id) or ("user", guild, user)
+    return channel_section(key[1], buckets) if key[0] == "channel" else guild_section(key[1])
+
+def encode_section(obj, compress=True):
+    payload = json.dumps(obj, separators=(",", ":")).encode("utf-8")
+    return ZLIB + zlib.compress(payload) if compress else RAW + payload
+
+def decode_section(payload):
+    kind, body = payload[:1], payload[1:]
+    if kind == ZLIB:
+        body = zlib.decompress(body)
+    elif kind != RAW:
+        raise ValueError(f"Unknown snapshot section encoding {kind!r}")
+    return json.loads(body)
+
+# Split chat data (the export_data() / chat_data.json layout) into sections
+def partition(data, buckets=CHANNEL_BUCKETS):
+    sections = {}
+    for channel_id, state in data.get("channels", {}).items():
+        sections.setdefault(channel_section(channel_id, buckets), {})[channel_id] = state
+    for key in USER_KEYS:
+        for guild_id, users in data.get(key, {}).items():
+            sections.setdefault(guild_section(guild_id), {})[key] = users
+    meta = {key: value for key, value in data.items() if key != "channels" and key not in USER_KEYS}
+    if meta:
+        sections["meta"] = meta
+    return sections
+
+def merge_section(data, name, section):
+    if name.startswith("channels:"):
+        data.setdefault("channels", {}).update(section)
+    elif name.startswith("guild:"):
+        guild_id = name[len("guild:"):]
+        for key, users in section.items():
+            data.setdefault(key, {})[guild_id] = users
+    else:
+        data.update(section)
+
+# One channel/user from a section, with user state shaped like MemoryManager._user_state; None if absent
+def get_entry(section, key):
+    if key[0] == "channel":
+        state = section.get(key[1])
+        return None if state is None else {"memories": state.get("memories", []), "history": state.get("history", [])}
+    user_id = key[2]
+    if not any(user_id in section.get(name, {}) for name in USER_KEYS):
+        return None
+    return {
+        "model": section.get("user_models", {}).get(user_id),
+        "history": section.get("user_histories", {}).get(user_id, []),
+        "model_histories": section.get("user_model_histories", {}).get(user_id, {}),
+        "summaries": section.get("summaries", {}).get(user_id, {}),
+    }
+
+def set_entry(section, key, state):
+    if key[0] == "channel":
+        section[key[1]] = state
+        return
+    user_id = key[2]
+    section.setdefault("user_models", {})[user_id] = state.get("model")
+    section.setdefault("user_histories", {})[user_id] = state.get("history", [])
+    section.setdefault("user_model_histories", {})[user_id] = state.get("model_histories", {})
+    if state.get("summaries"):
+        section.setdefault("summaries", {})[user_id] = state["summaries"]
+    else:
+        section.get("summaries", {}).pop(user_id, None)
+
+# Writes the file in place; callers write to a temp file and swap it in
+def write_snapshot(filename, payloads, buckets=CHANNEL_BUCKETS):
+    index = {}
+    with open(filename, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, 0, 0, 0))
+        for name, payload in payloads.items():
+            f.write(SECTION_LENGTH.pack(len(payload)))
+            index[name] = [f.tell(), len(payload)]
+            f.write(payload)
+        index_offset = f.tell()
+        blob = json.dumps({"channel_buckets": buckets, "sections": index}, separators=(",", ":")).encode("utf-8")
+        f.write(blob)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, 0, index_offset, len(blob)))
+    return index_offset + len(blob)
+
+# Read side: the file is mapped rather than read, so opening it only parses the header and index
+# and each section is decoded when something asks for it.
+class Snapshot:
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, _, index_offset, index_length = HEADER.unpack_from(self._map, 0)
+            if magic != MAGIC:
+                raise ValueError(f"{filename} is not a chat data snapshot")
+            if version > VERSION:
+                raise ValueError(f"{filename} uses snapshot format {version}; this version reads up to {VERSION}")
+            index = json.loads(self._map[index_offset:index_offset + index_length])
+        except Exception:
+            self.close()
+            raise
+        self.buckets = index["channel_buckets"]
+        self.sections = index["sections"]
+
+    def raw(self, name):
+        offset, length = self.sections[name]
+        return self._map[offset:offset + length]
+
+    def read(self, name):
+        return decode_section(self.raw(name))
+
+    def to_data(self):
+        data = {"channels": {}, **{key: {} for key in USER_KEYS}}
+        for name in self.sections:
+            merge_section(data, name, self.read(name))
+        return data
+
+    def close(self):
+        if getattr(self, "_map", None) is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+def convert(json_filename, filename, compress=True):
+    with open(json_filename, "r") as f:
+        data = json.loads(f.read())
+    payloads = {name: encode_section(section, compress) for name, section in partition(data).items()}
+    tmp_filename = f"{filename}.tmp"
+    size = write_snapshot(tmp_filename, payloads)
+    os.replace(tmp_filename, filename)
+    return size
+
+def export_json(filename, json_filename):
+    snapshot = Snapshot(filename)
+    try:
+        data = snapshot.to_data()
+    finally:
+        snapshot.close()
+    tmp_filename = f"{json_filename}.tmp"
+    with open(tmp_filename, "w") as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmp_filename, json_filename)
+
+
+# Keeps chat data in a snapshot file (chat_data.snap) instead of chat_data.json. Nothing is decoded at
+# startup: a channel or user is read from its section when it is first needed, and read again after it
+# has been evicted. MemoryManager tracks which entries changed; a save re-encodes only the sections
+# holding them and copies the rest over byte for byte.
+class SnapshotDataManager(DataManager):
+    backend = "snapshot"
+    save_op = "snapshot"
+
+    def __init__(self, filename, json_filename=None, flush_interval=0, compress=True, cached_sections=4):
+        self.json_filename = json_filename
+        self.compress = compress
+        self.snapshot = None
+        self.buckets = CHANNEL_BUCKETS
+        # Recently decoded sections, so loading several users of one guild decodes it once
+        self.recent = OrderedDict()
+        self.cached_sections = cached_sections
+        # Entries taken by the save in progress; the file holds their old state until it finishes
+        self.saving = set()
+        self._save_lock = None
+        super().__init__(filename, flush_interval=flush_interval)
+        self.stats.update({"sections_read": 0, "sections_encoded": 0, "sections_copied": 0})
+
+    def _create_file(self):
+        write_snapshot(self.filename, {})
+
+    def attach(self, memory_manager):
+        super().attach(memory_manager)
+        memory_manager.track_dirty = True
+
+    def load_data(self, memory_manager):
+        started = time.perf_counter()
+        try:
+            self._open()
+            if self.json_filename and os.path.exists(self.json_filename) and not self.snapshot.sections:
+                size = self._import_json()
+                logger.info(f"Imported {self.json_filename} into {self.filename} ({size} bytes)")
+        except Exception as e:
+            logger.error(f"Error loading snapshot {self.filename}: {e}")
+            raise
+        logger.info(f"Opened {self.filename} with {len(self.snapshot.sections)} sections in {time.perf_counter() - started:.3f}s")
+
+    def _open(self):
+        self.snapshot = Snapshot(self.filename)
+        self.buckets = self.snapshot.buckets
+
+    def _import_json(self):
+        self.snapshot.close()
+        self.snapshot = None
+        size = convert(self.json_filename, self.filename, self.compress)
+        self._open()
+        return size
+
+    def _section(self, name):
+        section = self.recent.get(name)
+        if section is not None:
+            self.recent.move_to_end(name)
+            return section
+        if name not in self.snapshot.sections:
+            return {}
+        section = self.recent[name] = self.snapshot.read(name)
+        self.stats["sections_read"] += 1
+        while len(self.recent) > self.cached_sections:
+            self.recent.popitem(last=False)
+        return section
+
+    def _load(self, key):
+        # Evicted before its changes were saved, so the file is behind
+        if key in self.cold:
+            return self._thaw(key)
+        return get_entry(self._section(entry_section(key, self.buckets)), key) or {}
+
+    def load_channel(self, channel_id):
+        state = self._load(("channel", channel_id))
+        return state.get("memories", []), state.get("history", [])
+
+    def load_user(self, guild_id, user_id):
+        return self._load(("user", guild_id, user_id))
+
+    # Evicted entries are read back from the file; only changes not saved yet are kept in memory
+    def _unsaved(self, key):
+        return key in self.memory_manager.dirty or key in self.saving
+
+    def spill_channel(self, channel_id, memories, history):
+        if self._unsaved(("channel", channel_id)):
+            super().spill_channel(channel_id, memories, history)
+
+    def spill_user(self, guild_id, user_id, state):
+        if self._unsaved(("user", guild_id, user_id)):
+            super().spill_user(guild_id, user_id, state)
+
+    def _build_sections(self, memory_manager, dirty):
+        keys = {}
+        for key in dirty:
+            keys.setdefault(entry_section(key, self.buckets), []).append(key)
+        sections = {}
+        for name, members in keys.items():
+            # A fresh decode, since it is modified below
+            section = sections[name] = self.snapshot.read(name) if name in self.snapshot.sections else {}
+            for key in members:
+                state = memory_manager.export_entry(key)
+                if state is None and key in self.cold:
+                    state = json.loads(zlib.decompress(self.cold[key]))
+                if state is not None:
+                    set_entry(section, key, state)
+        return sections
+
+    def _write_sections(self, sections):
+        payloads = {name: encode_section(section, self.compress) for name, section in sections.items()}
+        copied = [name for name in self.snapshot.sections if name not in payloads]
+        for name in copied:
+            payloads[name] = self.snapshot.raw(name)
+        size = write_snapshot(f"{self.filename}.tmp", payloads, self.buckets)
+        self.stats["sections_encoded"] += len(sections)
+        self.stats["sections_copied"] += len(copied)
+        return size
+
+    def _commit(self):
+        # The mapping has to go before the file under it can be replaced on Windows
+        self.snapshot.close()
+        self.snapshot = None
+        try:
+            os.replace(f"{self.filename}.tmp", self.filename)
+        finally:
+            self._open()
+
+    def _saved(self, started, size, memory_manager):
+        self.recent.clear()
+        # Evicted entries that haven't changed since are in the file now
+        for key in [key for key in self.cold if key not in memory_manager.dirty]:
+            del self.cold[key]
+        SAVE_SECONDS.observe(time.perf_counter() - started, backend=self.backend, op=self.save_op)
+        SAVE_BYTES.inc(size, backend=self.backend)
+        self.stats["writes"] += 1
+        logger.debug(f"Data saved successfully to {self.filename}")
+
+    async def _write_async(self, memory_manager):
+        if self._save_lock is None:
+            self._save_lock = asyncio.Lock()
+        async with self._save_lock:
+            started = time.perf_counter()
+            dirty = self.saving = memory_manager.take_dirty()
+            try:
+                sections = self._build_sections(memory_manager, dirty)
+                # Encoding and writing happen off the event loop; the sections are fresh copies
+                size = await asyncio.get_running_loop().run_in_executor(None, self._write_sections, sections)
+                self._commit()
+            except Exception as e:
+                memory_manager.dirty.update(dirty)
+                self.stats["errors"] += 1
+                logger.error(f"Error saving data to {self.filename}: {e}")
+                return False
+            finally:
+                self.saving = set()
+            self._saved(started, size, memory_manager)
+            return True
+
+    def save_data(self, memory_manager):
+        started = time.perf_counter()
+        dirty = memory_manager.take_dirty()
+        try:
+            size = self._write_sections(self._build_sections(memory_manager, dirty))
+            self._commit()
+        except Exception as e:
+            memory_manager.dirty.update(dirty)
+            self.stats["errors"] += 1
+            logger.error(f"Error saving data to {self.filename}: {e}")
+            return False
+        self._saved(started, size, memory_manager)
+        self.dirty = False
+        self.pending_changes = 0
+        return True
+
+    async def close(self, memory_manager=None):
+        await super().close(memory_manager)
+        if self.snapshot is not None:
+            self.snapshot.close()
+            self.snapshot = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert chat data between chat_data.json and the snapshot format")
+    parser.add_argument("source", help="chat_data.json to convert, or a snapshot with --to-json")
+    parser.add_argument("target", help="snapshot file to write, or chat_data.json with --to-json")
+    parser.add_argument("--to-json", action="store_true", help="write a snapshot back out as chat_data.json")
+    parser.add_argument("--no-compress", action="store_true", help="store sections without zlib compression")
+    args = parser.parse_args()
+    if args.to_json:
+        export_json(args.source, args.target)
+        print(f"Wrote {args.target} ({os.path.getsize(args.target)} bytes)")
+        return 0
+    size = convert(args.source, args.target, compress=not args.no_compress)
+    print(f"Wrote {args.target}: {size} bytes (was {os.path.getsize(args.source)} bytes)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,455 @@
+import os
+import json
+import asyncio
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from data_manager import SAVE_SECONDS, SAVE_BYTES
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS channel_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    user_id TEXT,
+    timestamp REAL,
+    status TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_channel_history ON channel_history (channel_id, id);
+CREATE TABLE IF NOT EXISTS channel_memories (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel_id TEXT NOT NULL,
+    memory TEXT NOT NULL,
+    UNIQUE (channel_id, memory)
+);
+CREATE TABLE IF NOT EXISTS user_models (
+    guild_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    model TEXT,
+    PRIMARY KEY (guild_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS user_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    guild_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp REAL,
+    status TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_user_history ON user_history (guild_id, user_id, id);
+CREATE TABLE IF NOT EXISTS user_model_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    guild_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    model TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp REAL,
+    status TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_user_model_history ON user_model_history (guild_id, user_id, model, id);
+CREATE TABLE IF NOT EXISTS user_summaries (
+    guild_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    model TEXT NOT NULL,
+    summary TEXT NOT NULL,
+    through REAL NOT NULL,
+    PRIMARY KEY (guild_id, user_id, model)
+);
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    origin TEXT NOT NULL,
+    channel_id TEXT,
+    guild_id TEXT,
+    user_id TEXT,
+    created REAL NOT NULL
+);
+"""
+
+CHANGE_RETENTION = 600
+
+class SQLiteDataManager:
+    def __init__(self, filename, json_filename=None, flush_interval=0, max_history=20, max_memories=5, sync_interval=0, origin=None):
+        self.filename = filename
+        self.json_filename = json_filename
+        self.flush_interval = flush_interval
+        self.max_history = max_history
+        self.max_memories = max_memories
+        self.memory_manager = None
+        self.pending = []
+        # With sync_interval > 0 other processes share this database; each batch is logged to `changes`
+        # and rows written by other origins evict the matching cached state here
+        self.sync_interval = sync_interval
+        self.origin = origin or str(os.getpid())
+        self.last_seq = 0
+        self.last_prune = 0.0
+        self.stats = {"changes": 0, "save_requests": 0, "batches": 0, "rows_written": 0, "channel_loads": 0, "user_loads": 0, "blocking_loads": 0, "remote_changes": 0, "errors": 0}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-store")
+        self._write_conn = self._executor.submit(self._connect).result()
+        self._read_conn = self._connect()
+        self._flush_handle = None
+        self._flush_task = None
+        self._sync_task = None
+
+    def _connect(self):
+        conn = sqlite3.connect(self.filename, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        return conn
+
+    def load_data(self, memory_manager):
+        memory_manager.loader = self
+        if self.json_filename and os.path.exists(self.json_filename) and self._is_empty(self._read_conn):
+            self._executor.submit(self._import_json, self.json_filename).result()
+        logger.info(f"SQLite storage ready at {self.filename}; state loads on first access")
+
+    def attach(self, memory_manager):
+        self.memory_manager = memory_manager
+        memory_manager.loader = self
+        if self.on_change not in memory_manager.listeners:
+            memory_manager.add_listener(self.on_change)
+
+    def start(self):
+        if self.sync_interval <= 0 or (self._sync_task is not None and not self._sync_task.done()):
+            return
+        self.last_seq = self._read_conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+        self._sync_task = asyncio.create_task(self._sync_periodically())
+        logger.info(f"Sharing {self.filename} with other processes as {self.origin} (sync every {self.sync_interval}s)")
+
+    def _is_empty(self, conn):
+        for table in ("channel_history", "channel_memories", "user_models", "user_history", "user_model_history", "user_summaries"):
+            if conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone():
+                return False
+        return True
+
+    def _import_json(self, json_filename):
+        try:
+            with open(json_filename, "r") as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.error(f"Could not import {json_filename} into SQLite: {e}")
+            return
+        conn = self._write_conn
+        with conn:
+            # Several shard processes may start at once; only the first to take the write lock imports
+            conn.execute("BEGIN IMMEDIATE")
+            if not self._is_empty(conn):
+                return
+            for channel_id, channel_data in data.get("channels", {}).items():
+                conn.executemany(
+                    "INSERT OR IGNORE INTO channel_memories (channel_id, memory) VALUES (?, ?)",
+                    [(channel_id, m) for m in channel_data.get("memories", [])],
+                )
+                conn.executemany(
+                    "INSERT INTO channel_history (channel_id, role, content, user_id, timestamp, status) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(channel_id, m["role"], m["content"], m.get("user_id"), m.get("timestamp"), m.get("status", "active")) for m in channel_data.get("history", [])],
+                )
+            for guild_id, models in data.get("user_models", {}).items():
+                conn.executemany(
+                    "INSERT OR REPLACE INTO user_models (guild_id, user_id, model) VALUES (?, ?, ?)",
+                    [(guild_id, user_id, model) for user_id, model in models.items()],
+                )
+            for guild_id, histories in data.get("user_histories", {}).items():
+                for user_id, history in histories.items():
+                    conn.executemany(
+                        "INSERT INTO user_history (guild_id, user_id, role, content, timestamp, status) VALUES (?, ?, ?, ?, ?, ?)",
+                        [(guild_id, user_id, m["role"], m["content"], m.get("timestamp"), m.get("status", "active")) for m in history],
+                    )
+            for guild_id, users in data.get("user_model_histories", {}).items():
+                for user_id, models in users.items():
+                    for model, history in models.items():
+                        conn.executemany(
+                            "INSERT INTO user_model_history (guild_id, user_id, model, role, content, timestamp, status) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            [(guild_id, user_id, model, m["role"], m["content"], m.get("timestamp"), m.get("status", "active")) for m in history],
+                        )
+            for guild_id, users in data.get("summaries", {}).items():
+                for user_id, models in users.items():
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO user_summaries (guild_id, user_id, model, summary, through) VALUES (?, ?, ?, ?, ?)",
+                        [(guild_id, user_id, model, s["summary"], s["through"]) for model, s in models.items()],
+                    )
+        logger.info(f"Imported {json_filename} into SQLite storage")
+
+    def _query_channel(self, conn, channel_id):
+        memories = [row[0] for row in conn.execute(
+            "SELECT memory FROM channel_memories WHERE channel_id = ? ORDER BY id", (channel_id,)
+        )]
+        rows = conn.execute(
+            "SELECT role, content, user_id, timestamp, status FROM channel_history WHERE channel_id = ? ORDER BY id DESC LIMIT ?",
+            (channel_id, self.max_history),
+        ).fetchall()
+        history = [
+            {"role": role, "content": content, "user_id": user_id, "timestamp": timestamp, "status": status}
+            for role, content, user_id, timestamp, status in reversed(rows)
+        ]
+        return memories, history
+
+    def _query_user(self, conn, guild_id, user_id):
+        row = conn.execute(
+            "SELECT model FROM user_models WHERE guild_id = ? AND user_id = ?", (guild_id, user_id)
+        ).fetchone()
+        rows = conn.execute(
+            "SELECT role, content, timestamp, status FROM user_history WHERE guild_id = ? AND user_id = ? ORDER BY id DESC LIMIT ?",
+            (guild_id, user_id, self.max_history),
+        ).fetchall()
+        history = [
+            {"role": role, "content": content, "timestamp": timestamp, "status": status}
+            for role, content, timestamp, status in reversed(rows)
+        ]
+        model_histories = {}
+        for model, role, content, timestamp, status in conn.execute(
+            "SELECT model, role, content, timestamp, status FROM user_model_history WHERE guild_id = ? AND user_id = ? ORDER BY id",
+            (guild_id, user_id),
+        ):
+            model_histories.setdefault(model, []).append(
+                {"role": role, "content": content, "timestamp": timestamp, "status": status}
+            )
+        summaries = {
+            model: {"summary": summary, "through": through}
+            for model, summary, through in conn.execute(
+                "SELECT model, summary, through FROM user_summaries WHERE guild_id = ? AND user_id = ?", (guild_id, user_id)
+            )
+        }
+        return {"model": row[0] if row else None, "history": history, "model_histories": model_histories, "summaries": summaries}
+
+    # Blocking fallback for MemoryManager.initialize_*; normal loads come through fetch_* via preload. Left for
+    # entries evicted between preload and use (e.g. by a change from another shard mid-reply), where it costs one
+    # indexed lookup; blocking_loads counts how often that happens
+    def load_channel(self, channel_id):
+        self.stats["channel_loads"] += 1
+        self.stats["blocking_loads"] += 1
+        return self._query_channel(self._read_conn, channel_id)
+
+    def load_user(self, guild_id, user_id):
+        self.stats["user_loads"] += 1
+        self.stats["blocking_loads"] += 1
+        return self._query_user(self._read_conn, guild_id, user_id)
+
+    async def fetch_channel(self, channel_id):
+        self.stats["channel_loads"] += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._query_channel, self._write_conn, channel_id)
+
+    async def fetch_user(self, guild_id, user_id):
+        self.stats["user_loads"] += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._query_user, self._write_conn, guild_id, user_id)
+
+    def on_change(self, op, record):
+        self.stats["changes"] += 1
+        self.pending.append((op, record))
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_handle is not None or (self._flush_task is not None and not self._flush_task.done()):
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write_batch(self._take_pending())
+            return
+        self._flush_handle = loop.call_later(self.flush_interval, self._start_flush)
+
+    def _start_flush(self):
+        self._flush_handle = None
+        self._flush_task = asyncio.get_running_loop().create_task(self.flush())
+
+    def _take_pending(self):
+        batch, self.pending = self.pending, []
+        return batch
+
+    async def flush(self, memory_manager=None):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        while self.pending:
+            batch = self._take_pending()
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._executor, self._write_batch, batch)
+
+    def _write_batch(self, batch):
+        if not batch:
+            return
+        conn = self._write_conn
+        rows = 0
+        started = time.perf_counter()
+        try:
+            with conn:
+                for op, record in batch:
+                    rows += self._apply(conn, op, record)
+                if self.sync_interval > 0:
+                    touched = {(record.get("channel_id"), record.get("guild_id"), record.get("user_id")) for _, record in batch}
+                    now = time.time()
+                    conn.executemany(
+                        "INSERT INTO changes (origin, channel_id, guild_id, user_id, created) VALUES (?, ?, ?, ?, ?)",
+                        [(self.origin, channel_id, guild_id, user_id, now) for channel_id, guild_id, user_id in touched],
+                    )
+            SAVE_SECONDS.observe(time.perf_counter() - started, backend="sqlite", op="batch")
+            SAVE_BYTES.inc(sum(len(str(value)) for _, record in batch for value in record.values()), backend="sqlite")
+            self.stats["batches"] += 1
+            self.stats["rows_written"] += rows
+            logger.debug(f"Wrote {len(batch)} changes to SQLite in one transaction")
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"Error writing batch of {len(batch)} changes to {self.filename}: {e}")
+
+    def _apply(self, conn, op, record):
+        if op in ("user_message", "ai_message"):
+            role = op.split("_")[0]
+            channel_id = record["channel_id"]
+            guild_id = record["guild_id"]
+            user_id = record["user_id"]
+            model = record["model"]
+            content = record["content"]
+            timestamp = record["timestamp"]
+            conn.execute(
+                "INSERT INTO channel_history (channel_id, role, content, user_id, timestamp, status) VALUES (?, ?, ?, ?, ?, 'active')",
+                (channel_id, role, content, user_id, timestamp),
+            )
+            conn.execute(
+                "INSERT INTO user_history (guild_id, user_id, role, content, timestamp, status) VALUES (?, ?, ?, ?, ?, 'active')",
+                (guild_id, user_id, role, content, timestamp),
+            )
+            conn.execute(
+                "INSERT INTO user_model_history (guild_id, user_id, model, role, content, timestamp, status) VALUES (?, ?, ?, ?, ?, ?, 'active')",
+                (guild_id, user_id, model, role, content, timestamp),
+            )
+            conn.execute(
+                "DELETE FROM channel_history WHERE channel_id = ? AND id NOT IN "
+                "(SELECT id FROM channel_history WHERE channel_id = ? ORDER BY id DESC LIMIT ?)",
+                (channel_id, channel_id, self.max_history),
+            )
+            conn.execute(
+                "DELETE FROM user_history WHERE guild_id = ? AND user_id = ? AND id NOT IN "
+                "(SELECT id FROM user_history WHERE guild_id = ? AND user_id = ? ORDER BY id DESC LIMIT ?)",
+                (guild_id, user_id, guild_id, user_id, self.max_history),
+            )
+            conn.execute(
+                "DELETE FROM user_model_history WHERE guild_id = ? AND user_id = ? AND model = ? AND id NOT IN "
+                "(SELECT id FROM user_model_history WHERE guild_id = ? AND user_id = ? AND model = ? ORDER BY id DESC LIMIT ?)",
+                (guild_id, user_id, model, guild_id, user_id, model, self.max_history),
+            )
+            return 3
+        if op == "memory":
+            channel_id = record["channel_id"]
+            conn.execute(
+                "INSERT OR IGNORE INTO channel_memories (channel_id, memory) VALUES (?, ?)",
+                (channel_id, record["memory"]),
+            )
+            conn.execute(
+                "DELETE FROM channel_memories WHERE channel_id = ? AND id NOT IN "
+                "(SELECT id FROM channel_memories WHERE channel_id = ? ORDER BY id DESC LIMIT ?)",
+                (channel_id, channel_id, self.max_memories),
+            )
+            return 1
+        if op == "user_model":
+            conn.execute(
+                "INSERT OR REPLACE INTO user_models (guild_id, user_id, model) VALUES (?, ?, ?)",
+                (record["guild_id"], record["user_id"], record["model"]),
+            )
+            return 1
+        if op == "summary":
+            conn.execute(
+                "INSERT OR REPLACE INTO user_summaries (guild_id, user_id, model, summary, through) VALUES (?, ?, ?, ?, ?)",
+                (record["guild_id"], record["user_id"], record["model"], record["summary"], record["through"]),
+            )
+            return 1
+        if op == "reset_model_history":
+            conn.execute(
+                "DELETE FROM user_model_history WHERE guild_id = ? AND user_id = ? AND model = ?",
+                (record["guild_id"], record["user_id"], record["model"]),
+            )
+            conn.execute(
+                "DELETE FROM user_summaries WHERE guild_id = ? AND user_id = ? AND model = ?",
+                (record["guild_id"], record["user_id"], record["model"]),
+            )
+            return 2
+        if op == "wipe":
+            conn.execute("DELETE FROM channel_history WHERE channel_id = ?", (record["channel_id"],))
+            conn.execute(
+                "DELETE FROM user_history WHERE guild_id = ? AND user_id = ?",
+                (record["guild_id"], record["user_id"]),
+            )
+            conn.execute(
+                "DELETE FROM user_model_history WHERE guild_id = ? AND user_id = ?",
+                (record["guild_id"], record["user_id"]),
+            )
+            conn.execute(
+                "DELETE FROM user_summaries WHERE guild_id = ? AND user_id = ?",
+                (record["guild_id"], record["user_id"]),
+            )
+            return 4
+        logger.warning(f"Skipping unknown memory record {op}")
+        return 0
+
+    async def _sync_periodically(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await asyncio.sleep(self.sync_interval)
+                rows = await loop.run_in_executor(self._executor, self._read_changes)
+                if rows:
+                    # Persist local changes first; nothing runs between the flush and the eviction,
+                    # so the next load sees both our writes and the other process's
+                    await self.flush()
+                    self._evict(rows)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Error syncing shared state from {self.filename}: {e}")
+
+    def _read_changes(self):
+        conn = self._write_conn
+        rows = conn.execute(
+            "SELECT seq, channel_id, guild_id, user_id FROM changes WHERE seq > ? AND origin != ? ORDER BY seq",
+            (self.last_seq, self.origin),
+        ).fetchall()
+        if rows:
+            self.last_seq = rows[-1][0]
+        now = time.time()
+        if now - self.last_prune > 60:
+            self.last_prune = now
+            with conn:
+                conn.execute("DELETE FROM changes WHERE created < ?", (now - CHANGE_RETENTION,))
+        return rows
+
+    def _evict(self, rows):
+        memory_manager = self.memory_manager
+        if memory_manager is None:
+            return
+        for _, channel_id, guild_id, user_id in rows:
+            if channel_id:
+                memory_manager.evict_channel(channel_id)
+            if guild_id and user_id:
+                memory_manager.evict_user(guild_id, user_id)
+        self.stats["remote_changes"] += len(rows)
+        logger.debug(f"Evicted state touched by {len(rows)} changes from other processes")
+
+    async def save_data_async(self, memory_manager):
+        self.stats["save_requests"] += 1
+
+    def save_data(self, memory_manager):
+        self._executor.submit(self._write_batch, self._take_pending()).result()
+        return True
+
+    async def close(self, memory_manager=None):
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            try:
+                await self._sync_task
+            except asyncio.CancelledError:
+                pass
+            self._sync_task = None
+        await self.flush()
+        if self._flush_task is not None and not self._flush_task.done():
+            await self._flush_task
+        self._read_conn.close()
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._write_conn.close)
+        self._executor.shutdown(wait=True)
+        logger.info(f"Persistence stats: {self.stats}")
@@ -0,0 +1,49 @@
+import time
+import logging
+import contextlib
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+STARTUP_SECONDS = registry.gauge("unity_startup_seconds", "Seconds from process start until each startup phase finished", ["phase"])
+
+# Records when each startup phase ran, relative to process start, so restarts can be compared in the log
+class StartupProfile:
+    def __init__(self, started=None):
+        self.started = started if started is not None else time.perf_counter()
+        self.phases = {}
+
+    def now(self):
+        return time.perf_counter() - self.started
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = self.now()
+        try:
+            yield
+        finally:
+            self._record(name, start, self.now())
+
+    # A milestone is a phase with no duration of its own; only the first occurrence counts
+    def mark(self, name):
+        if name in self.phases:
+            return False
+        now = self.now()
+        self._record(name, now, now)
+        return True
+
+    def _record(self, name, start, end):
+        self.phases[name] = (start, end)
+        STARTUP_SECONDS.set(end, phase=name)
+
+    def summary(self):
+        parts = []
+        for name, (start, end) in sorted(self.phases.items(), key=lambda item: item[1]):
+            if end > start:
+                parts.append(f"{name} {start:.2f}-{end:.2f}s ({end - start:.2f}s)")
+            else:
+                parts.append(f"{name} at {end:.2f}s")
+        return ", ".join(parts)
+
+    def log(self, label):
+        logger.info(f"Startup profile ({label}): {self.summary()}")
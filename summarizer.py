@@ -0,0 +1,103 @@
+import time
+import asyncio
+import logging
+from rate_limiter import AdaptiveRateLimiter
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_SECONDS = registry.histogram("unity_summary_seconds", "Time to summarize older turns of a conversation")
+SUMMARIES = registry.counter("unity_summaries_total", "Conversation summaries attempted, by result", ["result"])
+
+SUMMARY_PROMPT = (
+    "Summarize the conversation below so it can replace the original turns as context for a chat assistant. "
+    "Keep names, facts, preferences, decisions and open questions; drop greetings and filler. "
+    "If an earlier summary is given, merge it in. Reply with the summary only, in at most {words} words."
+)
+
+# Compacts long user/model histories off the reply path: once enough turns have piled up past the
+# current summary, the older ones are folded into it through the API and the context builder sends
+# the summary in their place. Summary requests have their own pacing and circuit breakers and skip the
+# reply concurrency slots, so they never crowd out replies.
+class Summarizer:
+    def __init__(self, api_client, memory_manager, config, data_manager=None):
+        self.api_client = api_client
+        self.memory_manager = memory_manager
+        self.config = config
+        self.data_manager = data_manager
+        self.rate_limiter = AdaptiveRateLimiter(config.summary_rate_limit, 1)
+        self.tasks = {}
+        self.stats = {"scheduled": 0, "completed": 0, "failed": 0, "discarded": 0, "turns_summarized": 0}
+        memory_manager.add_listener(self.on_change)
+
+    def on_change(self, op, record):
+        if op != "ai_message" or self.config.summary_threshold <= 0:
+            return
+        key = (record["guild_id"], record["user_id"], record["model"])
+        if key in self.tasks or len(self.pending_turns(*key)) < self.config.summary_threshold:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self.stats["scheduled"] += 1
+        task = loop.create_task(self._summarize(*key))
+        self.tasks[key] = task
+        task.add_done_callback(lambda _: self.tasks.pop(key, None))
+
+    def pending_turns(self, guild_id, user_id, model):
+        summary = self.memory_manager.get_summary(guild_id, user_id, model)
+        through = summary["through"] if summary else 0.0
+        history = self.memory_manager.user_model_histories.get(guild_id, {}).get(user_id, {}).get(model, ())
+        return [msg for msg in history if msg.timestamp > through and msg.status == "active"]
+
+    def _prompt(self, previous, turns):
+        lines = []
+        if previous:
+            lines.append(f"Earlier summary:\n{previous['summary']}\n")
+        lines.append("Conversation:")
+        for msg in turns:
+            lines.append(f"{'User' if msg.role == 'user' else 'Assistant'}: {msg.content}")
+        return [
+            {"role": "system", "content": SUMMARY_PROMPT.format(words=self.config.summary_max_words)},
+            {"role": "user", "content": "\n".join(lines)},
+        ]
+
+    async def _summarize(self, guild_id, user_id, model):
+        previous = self.memory_manager.get_summary(guild_id, user_id, model)
+        turns = self.pending_turns(guild_id, user_id, model)[:-self.config.summary_keep_turns or None]
+        if not turns:
+            return
+        started = time.perf_counter()
+        try:
+            summary = await self.api_client.send_background(self._prompt(previous, turns), self.config.summary_model or model, self.rate_limiter)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            summary = f"Error: {e}"
+        SUMMARY_SECONDS.observe(time.perf_counter() - started)
+        if not summary or not summary.strip() or summary.startswith("Error:"):
+            self.stats["failed"] += 1
+            SUMMARIES.inc(result="failed")
+            logger.warning(f"Could not summarize history for user {user_id} with model {model}: {summary}")
+            return
+        # The history may have been reset, wiped or summarized elsewhere while the request was out
+        history = self.memory_manager.user_model_histories.get(guild_id, {}).get(user_id, {}).get(model, ())
+        if self.memory_manager.get_summary(guild_id, user_id, model) != previous or not any(msg is turns[-1] for msg in history):
+            self.stats["discarded"] += 1
+            SUMMARIES.inc(result="discarded")
+            return
+        self.memory_manager.set_summary(guild_id, user_id, model, summary.strip(), turns[-1].timestamp)
+        self.stats["completed"] += 1
+        self.stats["turns_summarized"] += len(turns)
+        SUMMARIES.inc(result="completed")
+        logger.info(f"Summarized {len(turns)} turns for user {user_id} with model {model}")
+        if self.data_manager is not None:
+            await self.data_manager.save_data_async(self.memory_manager)
+
+    async def close(self):
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        logger.info(f"Summarizer stats: {self.stats}")
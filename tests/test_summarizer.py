@@ -0,0 +1,78 @@
+import os
+import sys
+import asyncio
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from memory_manager import MemoryManager
+from message_handler import MessageHandler
+
+
+class FakeAPIClient:
+    def __init__(self):
+        self.background = []
+
+    async def send_message(self, messages, model):
+        return "hello back"
+
+    async def send_background(self, messages, model, rate_limiter):
+        self.background.append((messages, model))
+        return "They said hi and got a greeting back."
+
+
+class FakeChannel:
+    id = 1
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append(content)
+
+
+def make_config(monkeypatch):
+    monkeypatch.setenv("DISCORD_TOKEN", "x" * 59)
+    monkeypatch.setenv("POLLINATIONS_TOKEN", "LoadTestToken000")
+    monkeypatch.chdir(ROOT)
+    from config import Config
+    config = Config()
+    config.stream_responses = False
+    config.summary_threshold = 2
+    config.summary_keep_turns = 0
+    config.summary_rate_limit = 100
+    return config
+
+
+def test_summary_threshold_is_off_by_default(monkeypatch):
+    monkeypatch.delenv("SUMMARY_THRESHOLD", raising=False)
+    monkeypatch.setenv("DISCORD_TOKEN", "x" * 59)
+    monkeypatch.setenv("POLLINATIONS_TOKEN", "LoadTestToken000")
+    monkeypatch.chdir(ROOT)
+    from config import Config
+    assert Config().summary_threshold == 0
+
+
+def test_full_reply_is_recorded_and_summarized(monkeypatch):
+    config = make_config(monkeypatch)
+    memory_manager = MemoryManager(20, 50)
+    api_client = FakeAPIClient()
+    handler = MessageHandler(api_client, memory_manager, config)
+    channel = FakeChannel()
+    message = SimpleNamespace(content="hi", channel=channel, guild=None, author=SimpleNamespace(id=5))
+
+    async def run():
+        assert await handler._handle_message(message) == "send"
+        await asyncio.gather(*handler.summarizer.tasks.values())
+        await handler.summarizer.close()
+
+    asyncio.run(run())
+
+    assert channel.sent and "hello back" in channel.sent[-1]
+    assert [(msg.role, msg.content) for msg in memory_manager.channel_histories["1"]] == [("user", "hi"), ("ai", "hello back")]
+    model = memory_manager.get_user_model("DM", "5")
+    assert len(api_client.background) == 1
+    summary = memory_manager.get_summary("DM", "5", model)
+    assert summary["summary"] == "They said hi and got a greeting back."
+    assert handler.summarizer.stats["completed"] == 1